@@ -4,12 +4,19 @@
 ## Authors: Alex Mancera, Stephen Panossian, Analia Treviño-Flitton
 ## HRVY- Heart Rate Viewer in PYthon Version 1.0
 
+from bisect import bisect_left, insort
+from functools import lru_cache
+
 import numpy as np
 from heartpy import smooth_signal
-from scipy.signal import butter, filtfilt, iirnotch, savgol_filter
+from scipy.ndimage import convolve1d
+from scipy.signal import (butter, filtfilt, iirnotch, lfilter, lfilter_zi, oaconvolve, savgol_coeffs, savgol_filter,
+                          sosfilt, sosfilt_zi, sosfiltfilt, tf2sos)
 
 # --------------------- HeartPy Source Code Start --------------------------------------------------
 __all__ = ['filter_signal',
+           'hampel_filter',
+           'hampel_correcter',
            'smooth_signal',
            'get_samplerate_datetime']
 
@@ -36,42 +43,117 @@ def butter_bandpass(lowcut, highcut, sample_rate, order=2):
     return b, a
 
 
+# block streams the filter as second-order sections one block at a time (see sosfiltfilt_blocks),
+# memory is then bounded by the block size, results go to out if given
+# data may also be 2-D (nodes x samples), every row is filtered along the sample axis in one call
+# float32 data is always block streamed, the sections & their state stay float64 & only the results are
+# stored as float32, b & a with a pole this close to 1 would not survive single precision
 def filter_signal(data, cutoff, sample_rate, order=2, filtertype='highpass',
-                  return_top=False):  # changed 'lowpass' to 'highpass' for more accuracy
-    if filtertype.lower() == 'lowpass':
-        b, a = butter_lowpass(cutoff, sample_rate, order=order)
-    elif filtertype.lower() == 'highpass':
-        b, a = butter_highpass(cutoff, sample_rate, order=order)
-    elif filtertype.lower() == 'bandpass':
-        assert type(cutoff) == tuple or list or np.array, 'if bandpass filter is specified, \
-cutoff needs to be array or tuple specifying lower and upper bound: [lower, upper].'
-        b, a = butter_bandpass(cutoff[0], cutoff[1], sample_rate, order=order)
-    elif filtertype.lower() == 'notch':
-        b, a = iirnotch(cutoff, Q=0.005, fs=sample_rate)
-    else:
-        raise ValueError('filtertype: %s is unknown, available are: \
-lowpass, highpass, bandpass, and notch' % filtertype)
+                  return_top=False, block=None, out=None):  # changed 'lowpass' to 'highpass' for more accuracy
+    if block is None and np.asarray(data).dtype == np.float32:
+        block = 262144
+    if block is not None:
+        sos = filter_coefficients(cutoff, sample_rate, order=order, filtertype=filtertype, sos=True)
+        filtered_data = sosfiltfilt_blocks(sos, data, out=out, block=block)
+        if return_top:
+            np.clip(filtered_data, a_min=0, a_max=None, out=filtered_data)
+        return filtered_data
+
+    b, a = filter_coefficients(cutoff, sample_rate, order=order, filtertype=filtertype)
 
-    filtered_data = filtfilt(b, a, data)
+    if out is not None:
+        # every row streamed straight into out in one call, the same values as filtfilt (see filtfilt_blocks)
+        filtered_data = filtfilt_blocks(b, a, data, out=out)
+    else:
+        filtered_data = filtfilt(b, a, data, axis=-1)
 
     if return_top:
-        return np.clip(filtered_data, a_min=0, a_max=None)
+        return np.clip(filtered_data, a_min=0, a_max=None, out=filtered_data)
     else:
         return filtered_data
 
 
-def remove_baseline_wander(data, sample_rate, cutoff=0.05):
-    return filter_signal(data=data, cutoff=cutoff, sample_rate=sample_rate, filtertype='notch')
+# method='median' subtracts a moving median over median_window seconds instead of notch filtering
+def remove_baseline_wander(data, sample_rate, cutoff=0.05, block=None, out=None, method='notch', median_window=1.0):
+    if method == 'median':
+        data = np.asarray(data, dtype=np.float64)
+        if out is None:
+            out = np.empty(data.shape)
+        size = int(median_window * sample_rate) // 2 * 2 + 1
+        for row, row_out in zip(data.reshape(-1, data.shape[-1]), out.reshape(-1, out.shape[-1])):
+            row_out[:] = row - rolling_median(row, size)
+        return out
+    elif method != 'notch':
+        raise ValueError('method: %s is unknown, available are: notch and median' % method)
+    return filter_signal(data=data, cutoff=cutoff, sample_rate=sample_rate, filtertype='notch',
+                         block=block, out=out)
+
+
+def MAD(data):
+    med = np.median(data)
+    return np.median(np.abs(data - med))
+
+
+# same result as the sample by sample version, replaced values are kept in the window for later samples,
+# but the median & MAD come from a RollingWindow rather than a fresh slice at every sample
+def hampel_filter(data, filtsize=6):
+    #generate second list to prevent overwriting first
+    #cast as array to be sure, in case list is passed
+    output = np.copy(np.asarray(data))
+    onesided_filt = filtsize // 2
+    if onesided_filt == 0:
+        return output
+    values = output.tolist()
+    window = RollingWindow(values[:2 * onesided_filt])
+    for i in range(onesided_filt, len(values) - onesided_filt - 1):
+        if i > onesided_filt:
+            window.remove(values[i - onesided_filt - 1])
+            window.add(values[i + onesided_filt - 1])
+        # MAD is never negative, so it is only needed for values above the median
+        median = window.median()
+        if values[i] > median and values[i] > median + (3 * window.mad(median)):
+            output[i] = median
+            window.remove(values[i])
+            values[i] = output[i].item()
+            window.add(values[i])
+    return output
+
+
+def hampel_correcter(data, sample_rate):
+    return data - hampel_filter(data, filtsize=int(sample_rate))
+
+
+# array version of the pair by pair loop, same mask as heartpy's quotient_filter
+# RR_list may be 2-D (series x intervals) to screen many equal length series in one call,
+# a mask passed in is updated in place as before
+def quotient_filter(RR_list, RR_list_mask=[], iterations=2):
+    RR_array = np.asarray(RR_list, dtype=np.float64)
+    if len(RR_list_mask) == 0:
+        mask = np.zeros(RR_array.shape)
+    else:
+        assert np.shape(RR_list) == np.shape(RR_list_mask), \
+        'error: RR_list and RR_list_mask should be same length if RR_list_mask is specified'
+        mask = np.array(RR_list_mask)
+
+    quotient_update(mask, quotient_outside(RR_array), iterations)
+
+    if isinstance(RR_list_mask, np.ndarray) and RR_list_mask.size:
+        RR_list_mask[...] = mask
+    elif isinstance(RR_list_mask, list) and RR_list_mask:
+        RR_list_mask[:] = mask.tolist()
+    return mask
 
 
-def smooth_signal(data, sample_rate, window_length=None, polyorder=3):
+# results go to out if given (which may be data itself), see savgol_smooth
+def smooth_signal(data, sample_rate, window_length=None, polyorder=3, out=None, block=1000000):
     if window_length == None:
         window_length = sample_rate // 10
 
     if window_length % 2 == 0 or window_length == 0: window_length += 1
 
-    smoothed = savgol_filter(data, window_length=window_length,
-                             polyorder=polyorder)
+    # 2-D data (nodes x samples) is smoothed row by row in one call
+    smoothed = savgol_smooth(data, window_length=int(window_length),
+                             polyorder=polyorder, out=out, block=block)
     return smoothed
 
 
@@ -84,35 +166,44 @@ def get_samplerate_datetime(datetimedata, timeformat='%H:%M:%S.%f'):
     return sample_rate
 
 
-def scale_data(data, lower=0, upper=1024):
-    rng = np.max(data) - np.min(data)
+# results go to out if given (which may be data itself), otherwise to one new array, with no temporaries
+def scale_data(data, lower=0, upper=1024, out=None):
+    data = np.asarray(data)
     minimum = np.min(data)
-    data = (upper - lower) * ((data - minimum) / rng) + lower
-    return data
+    return scale_range(data, minimum, np.max(data), lower, upper, out)
 
 
-def enhance_peaks(hrdata, iterations=2):
-    scale_data(hrdata)
+# squared & rescaled in out (which may be hrdata itself), no temporaries
+def enhance_peaks(hrdata, iterations=2, out=None):
+    hrdata = np.asarray(hrdata)
+    if out is None:
+        out = np.empty(hrdata.shape, dtype=hrdata.dtype if hrdata.dtype.kind == 'f' else np.float64)
+    out[...] = hrdata
     for i in range(iterations):
-        hrdata = np.power(hrdata, 2)
-        hrdata = scale_data(hrdata)
-    return hrdata
+        np.power(out, 2, out=out)
+        scale_data(out, out=out)
+    return out
 
 
-def flip_signal(data, enhancepeaks=False, keep_range=True):
-    data_mean = np.mean(data)
-    data_min = np.min(data)
-    data_max = np.max(data)
+# inverted in out (which may be data itself), min, max & mean come from one data_range pass
+# inverting is monotonic, so the inverted min & max come from the same pass without another reduction
+def flip_signal(data, enhancepeaks=False, keep_range=True, out=None):
+    data = np.asarray(data)
+    (data_min, data_max, data_mean) = data_range(data)
+    if out is None:
+        out = np.empty(data.shape, dtype=data.dtype if data.dtype.kind == 'f' else np.float64)
 
     # invert signal
-    data = (data_mean - data) + data_mean
+    np.subtract(data_mean, data, out=out)
+    np.add(out, data_mean, out=out)
 
     if keep_range:
         # scale data so original range is maintained
-        data = scale_data(data, lower=data_min, upper=data_max)
+        scale_range(out, (data_mean - data_max) + data_mean, (data_mean - data_min) + data_mean,
+                    lower=data_min, upper=data_max, out=out)
     if enhancepeaks:
-        data = enhance_peaks(data)
-    return data
+        enhance_peaks(out, out=out)
+    return out
 
 
 # --------------------- HeartPy Source Code End ---------------------------------------------------
@@ -121,7 +212,358 @@ def flip_signal(data, enhancepeaks=False, keep_range=True):
 ''' HRVY- Heart Rate Viewer in PYthon Version 1.0 '''
 
 
+
+## Designs are cached (see design_filter), cutoff is keyed as a tuple for bandpass
+## sos=True gives the design as second-order sections
+def filter_coefficients(cutoff, sample_rate, order=2, filtertype='highpass', Q=0.005, sos=False):
+    if isinstance(cutoff, (list, tuple, np.ndarray)):
+        cutoff = tuple(float(c) for c in cutoff)
+    else:
+        cutoff = float(cutoff)
+    if sos:
+        ## sosfilt will not take a read-only array, so each caller gets its own copy
+        return design_sos(filtertype.lower(), cutoff, float(sample_rate), order, Q).copy()
+    return design_filter(filtertype.lower(), cutoff, float(sample_rate), order, Q)
+
+
+
+## Bounded LRU cache of coefficient sets, shared by every filtering stage
+## Arrays handed out are read-only as every caller gets the same ones
+@lru_cache(maxsize=64)
+def design_filter(filtertype, cutoff, sample_rate, order=2, Q=0.005):
+    if filtertype == 'lowpass':
+        b, a = butter_lowpass(cutoff, sample_rate, order=order)
+    elif filtertype == 'highpass':
+        b, a = butter_highpass(cutoff, sample_rate, order=order)
+    elif filtertype == 'bandpass':
+        assert type(cutoff) == tuple or list or np.array, 'if bandpass filter is specified, \
+cutoff needs to be array or tuple specifying lower and upper bound: [lower, upper].'
+        b, a = butter_bandpass(cutoff[0], cutoff[1], sample_rate, order=order)
+    elif filtertype == 'notch':
+        b, a = iirnotch(cutoff, Q=Q, fs=sample_rate)
+    else:
+        raise ValueError('filtertype: %s is unknown, available are: \
+lowpass, highpass, bandpass, and notch' % filtertype)
+    b.flags.writeable = False
+    a.flags.writeable = False
+    return b, a
+
+
+
+## Same designs as second-order sections, cached alongside
+## Butterworth sections come straight from butter, not from the rounded b & a
+@lru_cache(maxsize=64)
+def design_sos(filtertype, cutoff, sample_rate, order=2, Q=0.005):
+    nyq = 0.5 * sample_rate
+    if filtertype in ('lowpass', 'highpass'):
+        sos = butter(order, cutoff / nyq, btype=filtertype[:-4], output='sos')
+    elif filtertype == 'bandpass':
+        sos = butter(order, [cutoff[0] / nyq, cutoff[1] / nyq], btype='band', output='sos')
+    else:
+        sos = tf2sos(*design_filter(filtertype, cutoff, sample_rate, order, Q))
+    sos.flags.writeable = False
+    return sos
+
+
+
+## Hits & misses of both coefficient caches, e.g. to check they are working over a batch run
+## Notch sections are made from the cached b & a, so each new one shows up in design_filter as well
+def filter_cache_info():
+    return {'design_filter': design_filter.cache_info(), 'design_sos': design_sos.cache_info()}
+
+
+
+## Zero-phase sosfilt over fixed size blocks, same padding & initial conditions as sosfiltfilt
+## Rather than overlapping the blocks, the filter state is carried from block to block,
+## Forward over the whole array & then backward, so no overlap is needed however slowly the poles decay
+## Blocks run along the last axis, so 2-D data (nodes x samples) carries one state per row
+def sosfiltfilt_blocks(sos, data, out=None, block=1000000):
+    data = np.asarray(data)
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32 if data.dtype == np.float32 else np.float64)
+    num_vals = data.shape[-1]
+    if num_vals <= block:
+        out[...] = sosfiltfilt(sos, data, axis=-1)
+        return out
+
+    ## Odd extensions at either end, as sosfiltfilt pads
+    ## zi is shaped (sections, rows..., 2) so it scales by each row's edge value
+    ntaps = 2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+    edge = 3 * ntaps
+    zi = sosfilt_zi(sos).reshape((len(sos),) + (1,) * (data.ndim - 1) + (2,))
+    left = 2 * data[..., :1] - data[..., edge:0:-1]
+    right = 2 * data[..., -1:] - data[..., -2:-edge - 2:-1]
+
+    ## Forward pass, written straight to out
+    filtered, state = sosfilt(sos, left, zi=zi * left[..., :1])
+    for start in range(0, num_vals, block):
+        out[..., start:start + block], state = sosfilt(sos, data[..., start:start + block], zi=state)
+    right, state = sosfilt(sos, right, zi=state)
+
+    ## Backward pass over out, starting from the far end of the extension
+    filtered, state = sosfilt(sos, right[..., ::-1], zi=zi * right[..., -1:])
+    for stop in range(num_vals, 0, -block):
+        start = max(stop - block, 0)
+        filtered, state = sosfilt(sos, out[..., start:stop][..., ::-1], zi=state)
+        out[..., start:stop] = filtered[..., ::-1]
+    return out
+
+
+
+## Same for b & a, the values come out exactly as filtfilt's (default odd padding)
+## lfilter carries its state from block to block, so only the padding & one block are held on top of out
+def filtfilt_blocks(b, a, data, out=None, block=262144):
+    data = np.asarray(data)
+    if out is None:
+        out = np.empty(data.shape)
+    num_vals = data.shape[-1]
+    edge = 3 * max(len(a), len(b))
+    if num_vals <= edge:
+        out[...] = filtfilt(b, a, data, axis=-1)
+        return out
+
+    ## Odd extensions at either end, as filtfilt pads
+    ## zi is shaped (rows..., taps) so it scales by each row's edge value
+    zi = lfilter_zi(b, a).reshape((1,) * (data.ndim - 1) + (-1,))
+    left = 2 * data[..., :1] - data[..., edge:0:-1]
+    right = 2 * data[..., -1:] - data[..., -2:-edge - 2:-1]
+
+    ## Forward pass, written straight to out
+    filtered, state = lfilter(b, a, left, zi=zi * left[..., :1])
+    for start in range(0, num_vals, block):
+        out[..., start:start + block], state = lfilter(b, a, data[..., start:start + block], zi=state)
+    right, state = lfilter(b, a, right, zi=state)
+
+    ## Backward pass over out, starting from the far end of the extension
+    filtered, state = lfilter(b, a, right[..., ::-1], zi=zi * right[..., -1:])
+    for stop in range(num_vals, 0, -block):
+        start = max(stop - block, 0)
+        filtered, state = lfilter(b, a, out[..., start:stop][..., ::-1], zi=state)
+        out[..., start:stop] = filtered[..., ::-1]
+    return out
+
+
+
+## Sorted window of values for rolling order statistics, kept as a plain sorted list
+## add & remove find their place by bisect in O(log w) but shift the list in O(w), a memmove that stays
+## around 1-3us up to a few thousand values (hampel_filter's 6, rolling_median's 501 at 500Hz) & grows
+## linearly past that (about 12us at 50k values, 160us at 500k), a pure python O(log w) tree is slower
+## than the memmove at the window sizes used here
+class RollingWindow:
+    def __init__(self, values=()):
+        self.sorted = sorted(values)
+
+    def __len__(self):
+        return len(self.sorted)
+
+    def add(self, value):
+        insort(self.sorted, value)
+
+    def remove(self, value):
+        del self.sorted[bisect_left(self.sorted, value)]
+
+    ## Median as np.median gives it, middle two values averaged for an even count
+    def median(self):
+        mid = len(self.sorted) // 2
+        if len(self.sorted) % 2:
+            return self.sorted[mid]
+        return (self.sorted[mid - 1] + self.sorted[mid]) / 2
+
+    ## Median absolute deviation, the distances from the median are two sorted runs either side of it,
+    ## So the middle distances are found by binary search without sorting them
+    def mad(self, median=None):
+        if median is None:
+            median = self.median()
+        mid = len(self.sorted) // 2
+        split = bisect_left(self.sorted, median)
+        if len(self.sorted) % 2:
+            return self.kth_distance(mid, median, split)
+        return (self.kth_distance(mid - 1, median, split) + self.kth_distance(mid, median, split)) / 2
+
+    ## k-th smallest (from 0) of |value - median|, values below split count down from the median
+    def kth_distance(self, k, median, split):
+        values = self.sorted
+        lo = max(0, k + 1 - (len(values) - split))
+        hi = min(k + 1, split)
+        while lo < hi:
+            taken = (lo + hi) // 2
+            if median - values[split - 1 - taken] < values[split + k - taken] - median:
+                lo = taken + 1
+            else:
+                hi = taken
+        rest = k + 1 - lo
+        if lo == 0:
+            return values[split + rest - 1] - median
+        if rest == 0:
+            return median - values[split - lo]
+        return max(median - values[split - lo], values[split + rest - 1] - median)
+
+
+
+## Centred moving median, the window is cut short at either end
+def rolling_median(data, size):
+    values = np.asarray(data, dtype=np.float64).tolist()
+    half = size // 2
+    medians = np.empty(len(values))
+    window = RollingWindow(values[:half])
+    for i in range(len(values)):
+        if i + half < len(values):
+            window.add(values[i + half])
+        if i > half:
+            window.remove(values[i - half - 1])
+        medians[i] = window.median()
+    return medians
+
+
+
+## RR series of any lengths screened in one call, returns a mask for each
+## The series are run end to end, with no pair taken across two of them
+def quotient_filter_batch(RR_lists, RR_list_masks=None, iterations=2):
+    lengths = [len(RR_list) for RR_list in RR_lists]
+    if len(lengths) == 0:
+        return []
+    ends = np.cumsum(lengths, dtype=np.int64)
+    RR_array = np.concatenate([np.asarray(RR_list, dtype=np.float64) for RR_list in RR_lists] + [np.empty(0)])
+    if RR_list_masks is None:
+        mask = np.zeros(len(RR_array))
+    else:
+        assert [len(RR_list_mask) for RR_list_mask in RR_list_masks] == lengths, \
+        'error: every RR_list_mask should be the same length as its RR_list'
+        mask = np.concatenate([np.asarray(RR_list_mask, dtype=np.float64) for RR_list_mask in RR_list_masks]
+                              + [np.empty(0)])
+
+    outside = quotient_outside(RR_array)
+    outside[ends[ends < len(RR_array)] - 1] = False
+    quotient_update(mask, outside, iterations)
+
+    return np.split(mask, ends[:-1])
+
+
+
+## Pairs whose ratio is outside 0.8 - 1.2 (or not a number), along the last axis
+def quotient_outside(RR_array):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = RR_array[..., :-1] / RR_array[..., 1:]
+    return ~((0.8 <= ratio) & (ratio <= 1.2))
+
+
+
+## A pair only ever marks its first interval, so every pair of an iteration sees the mask as it was
+## Before the iteration & the whole iteration is one array operation
+def quotient_update(mask, outside, iterations):
+    for iteration in range(iterations):
+        update = (mask[..., :-1] + mask[..., 1:] == 0) & outside
+        mask[..., :-1][update] = 1
+    return mask
+
+
+
+## savgol_filter (mode='interp') with the kernel cached, applied by direct convolution for short windows
+## & by FFT (overlap-add, block samples at a time) for long ones, written straight into out
+## out may be data itself, the samples a block overwrites are kept until the next block has read them
+def savgol_smooth(data, window_length, polyorder=3, out=None, block=1000000, method='auto'):
+    data = np.asarray(data)
+    if data.dtype.kind != 'f':
+        data = data.astype(np.float64)
+    num_vals = data.shape[-1]
+    if window_length % 2 == 0 or num_vals < window_length:
+        ## savgol_filter's own handling, or its error for too short a signal
+        smoothed = savgol_filter(data, window_length=window_length, polyorder=polyorder, axis=-1)
+        if out is None:
+            return smoothed
+        out[...] = smoothed
+        return out
+
+    (coeffs, left, right) = savgol_kernel(window_length, polyorder)
+    half = window_length // 2
+    if out is None:
+        out = np.empty(data.shape, dtype=data.dtype)
+
+    ## Polynomial fits to the first & last windows, before out is written
+    ## Fitted row by row, a stack of rows would sum them in another order & a node in a stack
+    ## (corrected_dict) has to come out the same as on its own (corrected_parallel)
+    rows = data.reshape(-1, num_vals)
+    head = np.array([row[:window_length] @ left.T for row in rows]).reshape(data.shape[:-1] + (len(left),))
+    tail = np.array([row[-window_length:] @ right.T for row in rows]).reshape(data.shape[:-1] + (len(right),))
+
+    if method == 'auto':
+        method = 'fft' if window_length > 64 else 'direct'
+    if method == 'direct':
+        convolve1d(data, coeffs, axis=-1, output=out, mode='constant')
+    elif method == 'fft':
+        kernel = coeffs.reshape((1,) * (data.ndim - 1) + (window_length,))
+        interior = num_vals - 2 * half
+        carry = data[..., :half].copy()
+        for start in range(0, interior, block):
+            stop = min(start + block, interior)
+            section = np.concatenate((carry, data[..., start + half:stop + 2 * half]), axis=-1)
+            carry = section[..., stop - start:stop - start + half]
+            out[..., start + half:stop + half] = oaconvolve(section, kernel, mode='valid', axes=-1)
+    else:
+        raise ValueError('method: %s is unknown, available are: auto, direct, and fft' % method)
+
+    if half:
+        out[..., :half] = head
+        out[..., -half:] = tail
+    return out
+
+
+
+## Cached kernel with the matrices that fit the first & last windows as mode='interp' does,
+## The fitted polynomial evaluated on its own window is a projection, rows for the edge samples kept
+## Arrays handed out are read-only as every caller gets the same ones
+@lru_cache(maxsize=32)
+def savgol_kernel(window_length, polyorder=3):
+    coeffs = savgol_coeffs(window_length, polyorder)
+    half = window_length // 2
+    positions = np.linspace(-1, 1, window_length)
+    vander = np.vander(positions, polyorder + 1)
+    fit = vander @ np.linalg.pinv(vander)
+    left = fit[:half].copy()
+    right = fit[window_length - half:].copy()
+    for array in (coeffs, left, right):
+        array.flags.writeable = False
+    return coeffs, left, right
+
+
+
+## scale_data for a known min & max
+def scale_range(data, minimum, maximum, lower=0, upper=1024, out=None):
+    if out is None:
+        out = np.empty(data.shape, dtype=data.dtype if data.dtype.kind == 'f' else np.float64)
+    rng = maximum - minimum
+    np.subtract(data, minimum, out=out)
+    np.divide(out, rng, out=out)
+    np.multiply(out, upper - lower, out=out)
+    np.add(out, lower, out=out)
+    return out
+
+
+
+## min, max & mean of data, each block reduced while it is still in cache rather than three passes over
+## The whole array, block sums are added in float64
+def data_range(data, block=65536):
+    data = np.asarray(data)
+    if data.size <= block:
+        return np.min(data), np.max(data), np.mean(data)
+    flat = data.reshape(-1)
+    lows = np.empty((flat.size + block - 1) // block, dtype=data.dtype)
+    highs = np.empty(len(lows), dtype=data.dtype)
+    total = 0.0
+    for n, start in enumerate(range(0, flat.size, block)):
+        part = flat[start:start + block]
+        lows[n] = part.min()
+        highs[n] = part.max()
+        total += part.sum(dtype=np.float64)
+    mean = total / flat.size
+    if data.dtype.kind == 'f':
+        mean = data.dtype.type(mean)
+    return lows.min(), highs.max(), mean
+
+
+
 ## Opens files & returns them as lists
+## A cat file is memory-mapped instead, its csv rows come back as a buffer for time_out_np, see cat_file_mmap
 def file_opener(dataset):
     import os
     contents = 'end'
@@ -150,7 +592,7 @@ def file_opener(dataset):
             ## If hdr wasn't found, check csv for hdr data
             if hdr_found != True:
                 try:
-                    contents = cat_file_parser(dataset + '.csv')
+                    contents = cat_file_mmap(dataset + '.csv')
                     break
                 except FileNotFoundError:
                     print('Not a csv file nested with hdr data')
@@ -160,7 +602,7 @@ def file_opener(dataset):
         elif file.startswith(dataset) and file.endswith('.cat'):
             try:
                 print("The cat file has been found in the directory")
-                contents = cat_file_parser(dataset + '.cat')
+                contents = cat_file_mmap(dataset + '.cat')
             except FileNotFoundError:
                 print('Not a cat file')
             break
@@ -196,10 +638,10 @@ def cat_file_parser(cat_file):
             return contents
 
     ## If it is a cat file, hdr contents will be deleted from csv list
+    ## Deleted as one slice so the list is only shifted once
     if del_num != 0:
         print('Concatenated data found')
-        for j in range(0, del_num):
-            del intro[0]
+        del intro[:del_num]
 
         ## Pack lists into tuples & return
         contents_tup = (hdr, intro)
@@ -223,7 +665,7 @@ def hdr_data(hdr):
         for item in l_split:
             hdr_dat[node][item.split()[0].strip(':')] = item.split()[1]
             if item.split()[0].strip(':') == 'period' and item.split()[1] != '2ms':
-                nodes_not_2ms[int(item.split()[1].strip('ms'))] = node
+                nodes_not_2ms[node] = int(item.split()[1].strip('ms'))
         node += 1
 
     ## Packed into tuple and returned
@@ -233,15 +675,30 @@ def hdr_data(hdr):
 
 
   
+## Whether a node is in a selection of labels or ids, no selection keeps every node
+def wanted_node(label, node_id, nodes):
+    if nodes is None:
+        return True
+    wanted = {str(item) for item in nodes}
+
+    return label in wanted or label.split('(')[0] in wanted or str(node_id) in wanted
+
+
+
 ## Determines if csv is pre-aligned
-def align_plus_dat(hdr_dat, csv):
+## nodes is an optional set of node labels or ids, only those nodes get a column in the Recording
+def align_plus_dat(hdr_dat, csv, nodes=None):
     aligned = ''
 
     ## Number of lines in .hdr file
     num_nodes = len(hdr_dat)
 
     ## Number of columns at the beginning of .csv file
-    num_cols_start = len((csv[0]).split(','))
+    ## A buffer of rows (cat_file_mmap) has its first row cut off the front
+    if isinstance(csv, list):
+        num_cols_start = len((csv[0]).split(','))
+    else:
+        num_cols_start = len(buffer_first_row(csv).split(b','))
 
     ## Missing number of columns at the beginning of .csv file
     num_cols_mis = num_nodes + 1 - num_cols_start
@@ -254,15 +711,27 @@ def align_plus_dat(hdr_dat, csv):
         print('Missing columns found, csv file not pre-aligned')
         aligned = 'no'
 
-    ## Create new dictionary with the time for keys
-    file_dat = {}
+    ## Create new Recording with the time & a node for each (selected) hdr line, node info kept as metadata
+    ## The node's csv column is kept too, it is no longer the node's place in the Recording once nodes are left out
+    file_dat = Recording()
     file_dat['Time'] = []
+    labels = []
     for key in hdr_dat:
-        if hdr_dat[key]['label'] in file_dat:
-            file_dat[hdr_dat[key]['label'] + '(2)'] = []
+        if hdr_dat[key]['label'] in labels:
+            label = hdr_dat[key]['label'] + '(2)'
         else:
-            file_dat[hdr_dat[key]['label']] = []
+            label = hdr_dat[key]['label']
+        labels.append(label)
+        if not wanted_node(label, hdr_dat[key].get('id'), nodes):
+            continue
+        file_dat[label] = []
+        file_dat.meta[label] = {'id': hdr_dat[key].get('id'),
+                                'unit': hdr_dat[key].get('unit'),
+                                'period': int(hdr_dat[key].get('period', '2ms').strip('ms')),
+                                'node': key}
     hdr_dat.clear()
+    if nodes is not None:
+        print('Reading ' + str(len(file_dat.nodes)) + ' of ' + str(num_nodes) + ' nodes')
 
     ## Pack into tuples & return
     align_contents = (num_nodes, num_cols_start, num_cols_mis, aligned)
@@ -273,38 +742,38 @@ def align_plus_dat(hdr_dat, csv):
   
 
 ## Checks for time gaps & fills is missing
+## Returns the filled Recording, gaps are kept in its gap table
 def time_out(csv, file_dat, nodes_not_2ms, align_cont):
     import datetime as dt
 
     ## Unpack tuple from align_plus_dat
     (num_nodes, num_cols_start, num_cols_mis, aligned) = align_cont
 
+    ## csv column of each node in the Recording
+    node_labels = {file_dat.meta[key]['node']: key for key in file_dat.nodes}
+
     ## Set time object
     last_line_time = ''
     two_ms = dt.timedelta(milliseconds=2)
+    epoch = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+    gaps = []
 
     for line in csv:
         ## If there is a timestamp, current time is kept as provided
         if not line.startswith(','):
             curr_line_time = dt.datetime.strptime(line.split(', ')[0], '%Y-%m-%d %H:%M:%S.%f %z')
 
-            ## Checks for time gap
+            ## Checks for time gap, the whole gap is filled with baseline in one go
+            ## Backwards or sub-2ms jumps still get one sample
             if last_line_time != '' and curr_line_time != last_line_time + two_ms:
-                time_dif = (curr_line_time - last_line_time).total_seconds()
-                if time_dif < 180:
-                    print(' >', time_dif, 'second gap starting at', last_line_time)
-
-                ## If time gap is over a minute long
-                else:
-                    print(' >', round(time_dif / 60, 3), 'minute gap starting at', last_line_time)
-                while curr_line_time != file_dat['Time'][-1] + two_ms:
-                    file_dat['Time'].append(file_dat['Time'][-1] + two_ms)
-                    for key, items in file_dat.items():
-                        if key != 'Time':
-                            items.append(0.5)
-                    if curr_line_time - two_ms <= file_dat['Time'][-1]:
-                        break
-                print(' Gap filled')
+                time_dif = curr_line_time - last_line_time
+                num_fill = max(1, -((two_ms - time_dif) // two_ms))
+                file_dat['Time'].extend(last_line_time + two_ms * n for n in range(1, num_fill + 1))
+                for key, items in file_dat.items():
+                    if key != 'Time':
+                        items.extend([0.5] * num_fill)
+                gaps.append(((last_line_time - epoch) // dt.timedelta(microseconds=1) * 1000,
+                             time_dif // dt.timedelta(microseconds=1) * 1000, num_fill))
             ## Saves current time for reference on next line
             last_line_time = curr_line_time
 
@@ -316,22 +785,27 @@ def time_out(csv, file_dat, nodes_not_2ms, align_cont):
         ## Records values from csv and fills in blank columns/values with recorded values
         ## Fills in blanks with recorded values or 0.5 (baseline) where data was not recorded
         for n in range(1, num_cols_start):
-            file_dat[list(file_dat)[n]].append(float(line.split(', ')[n].strip() or 0.5))
+            if n in node_labels:
+                file_dat[node_labels[n]].append(float(line.split(', ')[n].strip() or 0.5))
 
         ## If empty columns exist blanks are filled with 0.5 where columns are empty
         if aligned == 'no':
             for n in range(num_cols_mis):
+                if num_cols_start + n not in node_labels:
+                    continue
                 if len(line.split(', ')) < num_nodes + 1:
-                    file_dat[list(file_dat)[num_cols_start + n]].append(
+                    file_dat[node_labels[num_cols_start + n]].append(
                         0.5)
                 ## Fills in blanks with recorded values or 0.5 where data was not recorded
                 else:
-                    file_dat[list(file_dat)[num_cols_start + n]].append(float((line.split(', ')[
+                    file_dat[node_labels[num_cols_start + n]].append(float((line.split(', ')[
                                                                                    num_cols_start + n].strip() or 0.5)))
         ## If there are any non-2ms nodes, derive values for 2ms interval
         if len(nodes_not_2ms) > 0:
-            for interval, node in nodes_not_2ms.items():
-                node_list = file_dat[list(file_dat)[node]]
+            for node, interval in nodes_not_2ms.items():
+                if node not in node_labels:
+                    continue
+                node_list = file_dat[node_labels[node]]
                 min_start = (interval // 2) + 1
                 empty_vals = node_list[-(interval // 2):-1]
                 if len(node_list) > min_start and set(empty_vals) == {0.5} and node_list[-1] != 0.5:
@@ -341,11 +815,1318 @@ def time_out(csv, file_dat, nodes_not_2ms, align_cont):
                         node_list[-2 - n] = node_list[-1] + (mult * mis_val_int)
                         mult += 1
 
+    ## Lists are packed into the Recording's arrays, time as epoch ns
+    if len(file_dat['Time']) > 0:
+        file_dat.tz = file_dat['Time'][0].tzinfo
+    file_dat['Time'] = np.array([(t - epoch) // dt.timedelta(microseconds=1) * 1000 for t in file_dat['Time']],
+                                dtype=np.int64)
+    for key in file_dat.nodes:
+        file_dat[key] = np.array(file_dat[key], dtype=np.float64)
+    file_dat.gaps = np.array(gaps, dtype=gap_dtype)
+
     print('Done pulling data')
     return file_dat
 
 
-  
+
+## Splits a block of csv bytes into rows & field boundaries in one pass
+def csv_tokenizer(block):
+    buf = np.frombuffer(block, dtype=np.uint8)
+
+    ## Row boundaries, empty rows are dropped
+    ## Last row may not end in a newline, the buffer itself is never copied
+    row_ends = np.flatnonzero(buf == 10)
+    if len(buf) > 0 and buf[-1] != 10:
+        row_ends = np.append(row_ends, len(buf))
+    row_starts = np.zeros_like(row_ends)
+    row_starts[1:] = row_ends[:-1] + 1
+    keep = row_ends > row_starts
+    row_starts = row_starts[keep]
+    row_ends = row_ends[keep]
+
+    ## Field boundaries, a row has one more field than it has commas
+    ## Extra comma position at the end keeps lookups in range
+    commas = np.append(np.flatnonzero(buf == 44), len(buf))
+    first_comma = np.searchsorted(commas, row_starts)
+    num_fields = np.searchsorted(commas, row_ends) - first_comma + 1
+
+    ## Pack into tuple & return
+    tokens = (buf, row_starts, row_ends, commas, first_comma, num_fields)
+
+    return tokens
+
+
+
+## Pulls one column out of a tokenized block as fixed width bytes
+## Rows too short to have the column come back blank
+def column_field(tokens, col):
+    (buf, row_starts, row_ends, commas, first_comma, num_fields) = tokens
+    last = len(commas) - 1
+
+    ## Field starts after the previous comma & ends at the next comma or newline
+    if col == 0:
+        starts = row_starts
+    else:
+        starts = commas[np.minimum(first_comma + col - 1, last)] + 1
+    ends = np.where(col < num_fields - 1, commas[np.minimum(first_comma + col, last)], row_ends)
+    widths = np.where(col < num_fields, ends - starts, 0)
+
+    ## Copy every field into a space padded row of the widest field's size
+    width = max(int(widths.max()) if len(widths) > 0 else 0, 1)
+    offsets = np.arange(width)
+    chars = buf[np.minimum(starts[:, None] + offsets, len(buf) - 1)]
+    chars[offsets >= widths[:, None]] = 32
+    fields = np.ascontiguousarray(chars).view('S' + str(width)).ravel()
+
+    ## Blank if only whitespace is left
+    blank = np.all((chars == 32) | (chars == 9) | (chars == 13), axis=1)
+
+    return (fields, blank)
+
+
+
+## Converts one column of a tokenized block to floats, blanks become 0.5 (baseline)
+def column_values(tokens, col):
+    (fields, blank) = column_field(tokens, col)
+    values = np.full(len(fields), 0.5)
+    values[~blank] = fields[~blank].astype(np.float64)
+
+    return values
+
+
+
+## Converts a column of '%Y-%m-%d %H:%M:%S.%f %z' timestamps to int64 epoch ns in bulk
+## tz is the file's timezone, read off the first stamp & reused while the offsets match it
+## Stamps in any other layout fall back to strptime
+def decode_timestamps(stamps, tz=None):
+    import datetime as dt
+
+    stamps = np.asarray(stamps, dtype='S')
+    times = np.zeros(len(stamps), dtype=np.int64)
+    if len(stamps) == 0:
+        return (times, tz)
+    width = stamps.dtype.itemsize
+    chars = np.frombuffer(np.ascontiguousarray(stamps).tobytes(), dtype=np.uint8).reshape(len(stamps), width)
+
+    ## Length of each stamp without the padding
+    filled = (chars != 0) & (chars != 32)
+    lengths = width - np.argmax(filled[:, ::-1], axis=1)
+    digits = chars.astype(np.int64) - 48
+    done = np.zeros(len(stamps), dtype=bool)
+
+    ## Stamps are grouped by the number of %f digits, usually there is just the one group
+    for frac_len in range(1, 7):
+        rows = np.flatnonzero(lengths == 26 + frac_len)
+        if len(rows) == 0:
+            continue
+        d = digits[rows]
+        c = chars[rows]
+        tz_at = 21 + frac_len
+
+        ## Every digit & separator has to be where the format puts it
+        num_at = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18] + list(range(20, 20 + frac_len)) + list(range(tz_at + 1, tz_at + 5))
+        ok = np.all((d[:, num_at] >= 0) & (d[:, num_at] <= 9), axis=1)
+        for at, sep in ((4, b'-'), (7, b'-'), (10, b' '), (13, b':'), (16, b':'), (19, b'.'), (20 + frac_len, b' ')):
+            ok &= c[:, at] == ord(sep)
+        ok &= (c[:, tz_at] == ord('+')) | (c[:, tz_at] == ord('-'))
+
+        year = d[:, 0] * 1000 + d[:, 1] * 100 + d[:, 2] * 10 + d[:, 3]
+        month = d[:, 5] * 10 + d[:, 6]
+        day = d[:, 8] * 10 + d[:, 9]
+        hour = d[:, 11] * 10 + d[:, 12]
+        minute = d[:, 14] * 10 + d[:, 15]
+        second = d[:, 17] * 10 + d[:, 18]
+        ok &= (month >= 1) & (month <= 12) & (hour < 24) & (minute < 60) & (second < 60)
+
+        ## Day has to be in its month, 29 February only in leap years, anything else is left to strptime
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        month_days = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[np.clip(month, 0, 12)] + (leap & (month == 2))
+        ok &= (year >= 1) & (day >= 1) & (day <= month_days)
+        frac = np.zeros(len(rows), dtype=np.int64)
+        for k in range(frac_len):
+            frac = frac * 10 + d[:, 20 + k]
+
+        ## Days since 1970-01-01 from the civil date
+        y = year - (month <= 2)
+        era = y // 400
+        yoe = y - era * 400
+        doy = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+        days = era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + doy - 719468
+
+        ## Timezone offset, worked out once & reused while the stamps match it
+        offsets = c[:, tz_at:tz_at + 5]
+        if tz is None:
+            tz = dt.datetime.strptime(bytes(offsets[0]).decode(), '%z').tzinfo
+        tz_code = np.frombuffer(dt.datetime(2000, 1, 1, tzinfo=tz).strftime('%z').encode(), dtype=np.uint8)
+        if np.all(offsets == tz_code):
+            offset_ns = int(tz.utcoffset(None).total_seconds()) * 1000000000
+        else:
+            sign = np.where(c[:, tz_at] == ord('-'), -1, 1)
+            offset_ns = sign * ((d[:, tz_at + 1] * 10 + d[:, tz_at + 2]) * 3600 + (d[:, tz_at + 3] * 10 + d[:, tz_at + 4]) * 60) * 1000000000
+
+        times[rows] = ((days * 24 + hour) * 60 + minute) * 60000000000 + second * 1000000000 + frac * 10 ** (9 - frac_len) - offset_ns
+        done[rows[ok]] = True
+
+    ## Anything the fast path could not read goes through strptime
+    epoch = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+    for row in np.flatnonzero(~done):
+        stamp = dt.datetime.strptime(stamps[row].decode().strip(), '%Y-%m-%d %H:%M:%S.%f %z')
+        times[row] = (stamp - epoch) // dt.timedelta(microseconds=1) * 1000
+        if tz is None:
+            tz = stamp.tzinfo
+
+    return (times, tz)
+
+
+
+## Sample rate of a time base, no string conversion needed
+## Takes the int64 (ns) time base from the vectorized ingest or the datetime list from time_out
+def get_samplerate(times):
+    if isinstance(times, np.ndarray) and times.dtype == np.int64:
+        elapsed = (int(times[-1]) - int(times[0])) / 1e9
+    else:
+        elapsed = (times[-1] - times[0]).total_seconds()
+    sample_rate = len(times) / elapsed
+
+    return sample_rate
+
+
+
+## Derives 2ms values between the samples of a non-2ms node, same rules as time_out
+## Only runs that end at or after index 'first' are filled in
+def interp_node(node_vals, interval, first=None):
+    half = interval // 2
+    if half < 2:
+        return node_vals
+    if first is None:
+        first = half + 1
+
+    ## A node value follows a run of (half - 1) baseline values
+    base = np.concatenate(([0], np.cumsum(node_vals == 0.5)))
+    ends = np.arange(max(first, half), len(node_vals))
+    ends = ends[(base[ends] - base[ends - half + 1] == half - 1) & (node_vals[ends] != 0.5)]
+
+    ## Values in the run are stepped linearly back towards the previous sample
+    mult = np.arange(1, half)
+    mis_val_int = (node_vals[ends - half] - node_vals[ends]) / half
+    node_vals[ends[:, None] - mult] = node_vals[ends][:, None] + mult * mis_val_int[:, None]
+
+    return node_vals
+
+
+
+## Gap table columns: ns time of the last sample before the gap, length of the gap (ns)
+## & number of baseline samples filled in
+gap_dtype = np.dtype([('start', np.int64), ('duration', np.int64), ('samples', np.int64)])
+
+
+
+## Finds every time gap in one pass over the int64 (ns) row times
+## Returns the gap table & the row each gap comes before
+def find_gaps(row_time, last_line_time=None):
+    two_ms = 2000000
+
+    ## Each row should be 2ms after the one before
+    if last_line_time is None:
+        last_line_time = row_time[0] - two_ms if len(row_time) > 0 else 0
+    prev_time = np.concatenate(([last_line_time], row_time[:-1]))
+    time_dif = row_time - prev_time
+    gap_rows = np.flatnonzero(time_dif != two_ms)
+
+    ## Same sample count as time_out, backwards or sub-2ms jumps still get one sample
+    gaps = np.zeros(len(gap_rows), dtype=gap_dtype)
+    gaps['start'] = prev_time[gap_rows]
+    gaps['duration'] = time_dif[gap_rows]
+    gaps['samples'] = np.maximum(1, -((two_ms - time_dif[gap_rows]) // two_ms))
+
+    return (gaps, gap_rows)
+
+
+
+## Works out where each row lands once the gaps are filled & the time of every sample
+## Returns the filled time base & the position of each row in it
+def fill_gaps(row_time, gaps, gap_rows):
+    two_ms = 2000000
+
+    ## Each row is pushed back by the samples filled in before it
+    shift = np.zeros(len(row_time), dtype=np.int64)
+    shift[gap_rows] = gaps['samples']
+    row_pos = np.arange(len(row_time)) + np.cumsum(shift)
+
+    ## Filled samples count on 2ms at a time from the start of their gap
+    filled_time = np.empty(len(row_time) + int(gaps['samples'].sum()), dtype=np.int64)
+    is_fill = np.ones(len(filled_time), dtype=bool)
+    is_fill[row_pos] = False
+    gap_first = np.repeat(row_pos[gap_rows] - gaps['samples'], gaps['samples'])
+    filled_time[is_fill] = (np.repeat(gaps['start'], gaps['samples'])
+                            + (np.flatnonzero(is_fill) - gap_first + 1) * two_ms)
+    filled_time[row_pos] = row_time
+
+    return (filled_time, row_pos)
+
+
+
+## One node kept at its own period from the hdr instead of stretched onto the 2ms time base
+## Holds only the node's own samples, those on 2ms rows where (time // 2ms) % (period // 2) == phase
+## A dropout can restart the node on another phase, so phases is a list of [row, phase] pairs,
+## each phase holding from its row (on the 2ms time base) on, phase 0 throughout if there are none
+class Channel:
+    def __init__(self, values, period, phases=None):
+        self.values = values
+        self.period = period
+        self.phases = [] if phases is None else [list(pair) for pair in phases]
+        self.mark = (0, 0)
+
+    def __len__(self):
+        return len(self.values)
+
+    ## Positions of the node's own samples on a 2ms time base, first is the row of times[0]
+    def positions(self, times, first=0):
+        if len(self.phases) < 2:
+            phase = self.phases[0][1] if len(self.phases) > 0 else 0
+        else:
+            (starts, phases) = np.array(self.phases, dtype=np.int64).T
+            phase = phases[np.maximum(starts.searchsorted(first + np.arange(len(times)), side='right') - 1, 0)]
+        return np.flatnonzero((times // 2000000) % (self.period // 2) == phase)
+
+    ## Number of the node's own samples before a row, counted on from the last row asked about
+    def count_before(self, times, row):
+        (mark_row, mark_count) = self.mark if row >= self.mark[0] else (0, 0)
+        count = mark_count + len(self.positions(times[mark_row:row], mark_row))
+        self.mark = (row, count)
+        return count
+
+    ## Resamples rows start..stop of a 2ms time base, only done when a consumer asks for it
+    ## In-between values are linear like time_out's non-2ms fill
+    ## A period of rows either side brings in the own samples just outside the window
+    def on_grid(self, times, start=0, stop=None):
+        stop = len(times) if stop is None else min(stop, len(times))
+        lo = max(start - self.period, 0)
+        hi = min(stop + self.period, len(times))
+        seen = self.count_before(times, lo)
+        pos = self.positions(times[lo:hi], lo)
+        grid = np.interp(np.arange(start, stop), lo + pos, self.values[seen:seen + len(pos)])
+        grid = grid.astype(self.values.dtype, copy=False)
+
+        return grid
+
+
+
+## Node values on the 2ms time base, whether stored as a list, an array or a Channel
+## start & stop pick out a window of rows, the rest of the node is not read
+def node_on_grid(file_dat, key, start=0, stop=None):
+    items = file_dat[key]
+    if isinstance(items, Channel):
+        return items.on_grid(file_dat['Time'], start, stop)
+    if start == 0 and stop is None:
+        return items
+
+    return items[start:stop]
+
+
+
+## Compact container for a data set, passed between every hrvy stage in place of the dict of lists
+## Holds the int64 (epoch ns) time base, a contiguous float array (or Channel) per node,
+## the hdr metadata per node (id, unit, period), the gap table & the sample rate
+## store is the folder the columns are memory-mapped from, None when they are held in memory
+## Reads like the old dictionary, 'Time' first & then the node labels
+class Recording:
+    def __init__(self, time=None, nodes=None, meta=None, gaps=None, tz=None):
+        self.time = np.zeros(0, dtype=np.int64) if time is None else time
+        self.nodes = {} if nodes is None else nodes
+        self.meta = {} if meta is None else meta
+        self.gaps = np.zeros(0, dtype=gap_dtype) if gaps is None else gaps
+        self.tz = tz
+        self.rate = None
+        self.store = None
+
+    ## Worked out from the time base the first time it is asked for, then kept
+    @property
+    def sample_rate(self):
+        if self.rate is None and len(self.time) > 1:
+            self.rate = get_samplerate(self.time)
+        return self.rate
+
+    def __getitem__(self, key):
+        if key == 'Time':
+            return self.time
+        return self.nodes[key]
+
+    def __setitem__(self, key, items):
+        if key == 'Time':
+            self.time = items
+            self.rate = None
+        else:
+            self.nodes[key] = items
+
+    def __iter__(self):
+        yield 'Time'
+        yield from self.nodes
+
+    def __len__(self):
+        return len(self.nodes) + 1
+
+    def __contains__(self, key):
+        return key == 'Time' or key in self.nodes
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def clear(self):
+        self.time = self.time[:0]
+        self.nodes.clear()
+        self.rate = None
+
+    ## Node values on the 2ms time base, optionally just rows start..stop
+    def grid(self, key, start=0, stop=None):
+        return node_on_grid(self, key, start, stop)
+
+    ## Same time base, metadata & gaps with other node values, nothing is copied
+    def with_nodes(self, nodes):
+        rec = Recording(self.time, nodes, self.meta, self.gaps, self.tz)
+        rec.rate = self.rate
+        rec.store = self.store
+        return rec
+
+    ## Time base as local wall clock datetime64 values, for printing & plotting
+    def local_time(self, start=0, stop=None):
+        offset = 0 if self.tz is None else int(self.tz.utcoffset(None).total_seconds()) * 1000000000
+        return (self.time[start:stop] + offset).astype('datetime64[ns]')
+
+
+
+## Sets up the running state the vectorized ingest carries from block to block
+## native keeps non-2ms nodes at their own period (as Channels) instead of filling them in
+## dtype is what node values come out as, np.float32 halves memory (see README, Precision)
+## The held back tail stays float64, so values are only rounded once, on the way out
+def ingest_state(file_dat, nodes_not_2ms, align_cont, native=False, dtype=np.float64):
+    labels = list(file_dat)
+
+    ## csv column of each node, only these columns are converted
+    ## Non-2ms nodes that were left out are dropped
+    node_labels = {file_dat.meta.get(key, {}).get('node', n + 1): key for n, key in enumerate(file_dat.nodes)}
+    nodes_not_2ms = {node: interval for node, interval in nodes_not_2ms.items() if node in node_labels}
+
+    ## Last samples are held back until a non-2ms node can no longer change them
+    hold = 0 if native else max([interval // 2 for interval in nodes_not_2ms.values()] + [0])
+
+    state = {'labels': labels,
+             'node_labels': node_labels,
+             'nodes_not_2ms': nodes_not_2ms,
+             'align_cont': align_cont,
+             'last_line_time': None,
+             'tz': None,
+             'hold': hold,
+             'native': native,
+             'dtype': np.dtype(dtype),
+             'phases': {},
+             'emitted': 0,
+             'tail': {key: np.zeros(0, dtype=np.int64 if key == 'Time' else np.float64) for key in labels}}
+
+    return state
+
+
+
+## Parses one block of csv rows against the running state
+## Returns the samples that are final (the rest stay in the state's tail) & the block's gap table
+def ingest_block(block, state):
+    ## Unpack tuple from align_plus_dat
+    (num_nodes, num_cols_start, num_cols_mis, aligned) = state['align_cont']
+    labels = state['labels']
+    two_ms = 2000000
+
+    ## Tokenize the whole block at once
+    if not isinstance(block, (bytes, bytearray, memoryview)):
+        block = ''.join(block).encode()
+    tokens = csv_tokenizer(block)
+    num_fields = tokens[5]
+    num_rows = len(num_fields)
+    rows = np.arange(num_rows)
+
+    ## Rows with a timestamp keep it, all others are 2ms after the row before
+    (stamps, blank) = column_field(tokens, 0)
+    stamped = np.flatnonzero(~blank)
+    last_line_time = state['last_line_time']
+    if num_rows > 0 and last_line_time is None and (len(stamped) == 0 or stamped[0] != 0):
+        raise ValueError('First csv row has no timestamp')
+    (stamp_times, state['tz']) = decode_timestamps(stamps[stamped], state['tz'])
+
+    ## Rows before the block's first timestamp count on from the previous block
+    ref = np.full(num_rows, -1, dtype=np.int64)
+    ref[stamped] = stamped
+    ref = np.maximum.accumulate(ref)
+    row_time = np.zeros(num_rows, dtype=np.int64)
+    row_time[stamped] = stamp_times
+    row_time = np.where(ref >= 0, row_time[np.maximum(ref, 0)] + (rows - ref) * two_ms,
+                        (last_line_time or 0) + (rows + 1) * two_ms)
+
+    ## Records values from csv, blanks & missing columns are 0.5 (baseline)
+    ## Only the columns of nodes in the Recording are pulled out & converted
+    node_labels = state['node_labels']
+    row_vals = {}
+    for n, key in node_labels.items():
+        values = column_values(tokens, n)
+        if aligned == 'no' and n >= num_cols_start:
+            values[num_fields < num_nodes + 1] = 0.5
+        row_vals[key] = values
+
+    ## Finds time gaps, then lays the rows out behind the held back tail with the gaps filled
+    (gaps, gap_rows) = find_gaps(row_time, last_line_time)
+    num_tail = len(state['tail']['Time'])
+    (block_time, row_pos) = fill_gaps(row_time, gaps, gap_rows)
+    block_dat = {'Time': np.concatenate((state['tail']['Time'], block_time))}
+    for key, vals in row_vals.items():
+        values = np.full(num_tail + len(block_time), 0.5)
+        values[:num_tail] = state['tail'][key]
+        values[num_tail + row_pos] = vals
+        block_dat[key] = values
+    if num_rows > 0:
+        state['last_line_time'] = int(row_time[-1])
+
+    ## If there are any non-2ms nodes, derive values for 2ms interval
+    if not state['native']:
+        for node, interval in state['nodes_not_2ms'].items():
+            first = max(num_tail, interval // 2 + 1 - state['emitted'])
+            interp_node(block_dat[node_labels[node]], interval, first)
+
+    ## Hold back the last samples for the next block
+    num_out = max(len(block_dat['Time']) - state['hold'], 0)
+    for key in labels:
+        state['tail'][key] = block_dat[key][num_out:]
+        block_dat[key] = block_dat[key][:num_out]
+        if key != 'Time':
+            block_dat[key] = block_dat[key].astype(state['dtype'], copy=False)
+    state['emitted'] += num_out
+
+    ## Nodes kept at their own period only keep the samples that fall on it
+    ## Phase comes from the node's first recorded value, a recorded value off the phase (after a dropout)
+    ## starts a new phase from its row, so no recorded value is ever dropped
+    ## Each block's Channel has the phases counted from its own first row
+    if state['native']:
+        first_row = state['emitted'] - num_out
+        for node, interval in state['nodes_not_2ms'].items():
+            values = block_dat[node_labels[node]]
+            steps = (block_dat['Time'] // two_ms) % (interval // 2)
+            recorded = np.flatnonzero(values != 0.5)
+            phases = state['phases'].setdefault(node, [])
+            if len(phases) == 0 and num_out > 0:
+                phases.append([first_row, int(steps[recorded[0] if len(recorded) > 0 else 0])])
+            if len(recorded) > 0:
+                previous = np.concatenate(([phases[-1][1]], steps[recorded[:-1]]))
+                changed = recorded[steps[recorded] != previous]
+                phases.extend([first_row + int(row), int(steps[row])] for row in changed)
+            channel = Channel(values[:0], interval, [[row - first_row, phase] for row, phase in phases])
+            channel.values = values[channel.positions(block_dat['Time'])]
+            block_dat[node_labels[node]] = channel
+
+    ## Pack into tuple & return
+    block_gaps = (block_dat, gaps)
+
+    return block_gaps
+
+
+
+## Hands back whatever the state is still holding once the last block is in
+def ingest_flush(state):
+    block_dat = state['tail']
+    state['emitted'] += len(block_dat['Time'])
+    state['tail'] = {key: items[:0] for key, items in block_dat.items()}
+    block_dat = {key: items if key == 'Time' else items.astype(state['dtype'], copy=False)
+                 for key, items in block_dat.items()}
+
+    return block_dat
+
+
+
+## Vectorized version of time_out
+## Same filled values, numpy arrays per node with an int64 time base (epoch ns) in the Recording
+## native keeps non-2ms nodes at their own period, see Channel
+## dtype np.float32 keeps node values in single precision, see ingest_state
+def time_out_np(csv, file_dat, nodes_not_2ms, align_cont, native=False, dtype=np.float64):
+    state = ingest_state(file_dat, nodes_not_2ms, align_cont, native, dtype)
+    (block_dat, gaps) = ingest_block(csv, state)
+    if native:
+        parts = [block_dat]
+    else:
+        parts = [block_dat, ingest_flush(state)]
+    for key in file_dat:
+        file_dat[key] = parts[0][key] if len(parts) == 1 else np.concatenate([part[key] for part in parts])
+    file_dat.gaps = gaps
+    file_dat.tz = state['tz']
+
+    print('Done pulling data')
+    return file_dat
+
+
+
+## Streaming version of time_out, yields one Recording (with that block's gap table) per block of rows
+## Time & alignment carry over between blocks so the joined output matches time_out_np
+def time_out_stream(blocks, file_dat, nodes_not_2ms, align_cont, native=False, dtype=np.float64):
+    state = ingest_state(file_dat, nodes_not_2ms, align_cont, native, dtype)
+    for block in blocks:
+        (block_dat, gaps) = ingest_block(block, state)
+        if len(block_dat['Time']) > 0 or len(gaps) > 0:
+            yield block_recording(file_dat, block_dat, gaps, state['tz'])
+    block_dat = ingest_flush(state)
+    if len(block_dat['Time']) > 0:
+        yield block_recording(file_dat, block_dat, np.zeros(0, dtype=gap_dtype), state['tz'])
+
+    print('Done pulling data')
+
+
+
+## Wraps one block of ingested arrays in a Recording sharing the data set's metadata
+def block_recording(file_dat, block_dat, gaps, tz):
+    nodes = {key: items for key, items in block_dat.items() if key != 'Time'}
+
+    return Recording(block_dat['Time'], nodes, file_dat.meta, gaps, tz)
+
+
+
+## Reads a csv (or the data rows of a cat file) in blocks of a fixed number of rows
+## Stops at byte offset end if one is given
+def csv_block_reader(csv_file, block_rows=500000, offset=0, end=None):
+    from itertools import islice
+
+    with open(csv_file, 'rb') as f:
+        f.seek(offset)
+        while True:
+            block = b''.join(islice(f, block_rows))
+            if end is not None:
+                block = block[:max(end - offset, 0)]
+                offset += len(block)
+            if not block:
+                break
+            yield block
+
+
+
+## Streaming version of file_opener, finds the data set without reading its rows in
+## Returns the hdr lines, the file holding the csv rows & the byte offset they start at
+def file_locator(dataset):
+    import os
+
+    ## Matching csv & hdr files
+    if os.path.isfile(dataset + '.csv') and os.path.isfile(dataset + '.hdr'):
+        with open(dataset + '.hdr', 'r') as h:
+            hdr = h.readlines()
+        print('Both csv and hdr files found')
+        return (hdr, dataset + '.csv', 0)
+
+    ## Csv with nested hdr data or cat file
+    for ext in ('.csv', '.cat'):
+        if os.path.isfile(dataset + ext):
+            (hdr, offset) = cat_header_split(dataset + ext)
+            if len(hdr) > 0:
+                return (hdr, dataset + ext, offset)
+
+    print('Cannot locate a viable file, please make sure data set name, the file type, and the directory are correct')
+    return 'end'
+
+
+
+## Reads only the hdr lines at the top of a concatenated file
+## Returns them with the byte offset of the first csv row
+def cat_header_split(cat_file):
+    hdr = []
+    offset = 0
+
+    with open(cat_file, 'rb') as f:
+        for line in f:
+            if not line.startswith(b'{id:'):
+                break
+            hdr.append(line.decode())
+            offset += len(line)
+
+    if len(hdr) == 0:
+        print('This is not a concatenated file, no hdr data found')
+    else:
+        print('Concatenated data found')
+
+    return (hdr, offset)
+
+
+
+## Memory-maps a concatenated file & splits the hdr lines off without reading the data
+## Returns the hdr lines & a zero-copy view of the csv rows for the vectorized parser
+def cat_file_mmap(cat_file):
+    import mmap
+    import os
+
+    hdr = []
+    offset = 0
+
+    ## An empty file cannot be mapped & holds no hdr data anyway
+    if os.path.getsize(cat_file) == 0:
+        print('This is not a concatenated file, no hdr data found')
+        return 'end'
+    with open(cat_file, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    ## Only the pages holding the hdr block are touched
+    while mm[offset:offset + 4] == b'{id:':
+        line_end = mm.find(b'\n', offset)
+        if line_end == -1:
+            line_end = len(mm) - 1
+        hdr.append(mm[offset:line_end + 1].decode())
+        offset = line_end + 1
+
+    if len(hdr) == 0:
+        print('This is not a concatenated file, no hdr data found')
+        return 'end'
+    print('Concatenated data found')
+
+    ## Pack into tuple & return
+    contents_tup = (hdr, memoryview(mm)[offset:])
+
+    return contents_tup
+
+
+
+## First row of a buffer of csv rows, without its newline
+## Looked for in a growing piece off the front so the rest of the buffer is never touched
+def buffer_first_row(buffer):
+    size = 4096
+    while True:
+        piece = bytes(buffer[:size])
+        if b'\n' in piece or size >= len(buffer):
+            return piece.split(b'\n')[0]
+        size *= 2
+
+
+
+## Reads the first csv row, enough for align_plus_dat to check the alignment
+def first_csv_line(csv_file, offset=0):
+    with open(csv_file, 'r') as f:
+        f.seek(offset)
+        line = f.readline()
+
+    return [line]
+
+
+
+## Cache of a parsed data set, kept in a folder next to the data file (<data file>.hrvy)
+## meta.json has the source key, node info & the parser state, every column is a raw binary file
+## Columns are memory-mapped back in & new rows of a growing csv are appended to them
+## The path is made absolute so a Recording's store still points at it after a chdir (new_folder)
+def cache_folder(data_file):
+    import os
+
+    return os.path.abspath(data_file) + '.hrvy'
+
+
+
+## What a cache is keyed on: size, mtime & sha1 of each source file
+## Hashing is skipped unless asked for, size & mtime are enough to spot most changes
+def source_key(sources, with_hash=False):
+    import os
+
+    key = []
+    for source in sources:
+        stat = os.stat(source)
+        key.append({'file': os.path.basename(source),
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime_ns,
+                    'sha1': file_sha1(source) if with_hash else None})
+
+    return key
+
+
+
+## Content hash of a file, read in 1MB pieces
+## With segment ends given, the hash is chained segment by segment the same way the ingest hashes
+## what it parses (each segment is hashed behind the hex digest of the ones before it)
+def file_sha1(source, segments=None):
+    import hashlib
+    import os
+
+    if segments is None:
+        segments = [os.path.getsize(source)]
+    digest = ''
+    start = 0
+    with open(source, 'rb') as f:
+        for end in segments:
+            sha1 = hashlib.sha1(digest.encode())
+            while start < end:
+                piece = f.read(min(1 << 20, end - start))
+                if not piece:
+                    break
+                sha1.update(piece)
+                start += len(piece)
+            digest = sha1.hexdigest()
+
+    return digest
+
+
+
+## Hash of the last bytes before an offset, a cheap check that a file was only appended to
+def edge_sha1(source, offset, size=65536):
+    import hashlib
+
+    with open(source, 'rb') as f:
+        f.seek(max(offset - size, 0))
+        edge = f.read(offset - max(offset - size, 0))
+
+    return hashlib.sha1(edge).hexdigest()
+
+
+
+## Byte offset just past the last complete row, size is how much of the file to look at (all of it if None)
+def last_row_end(source, start=0, size=None):
+    import os
+
+    end = os.path.getsize(source) if size is None else size
+    with open(source, 'rb') as f:
+        while end > start:
+            f.seek(max(end - 65536, start))
+            piece = f.read(end - max(end - 65536, start))
+            found = piece.rfind(b'\n')
+            if found != -1:
+                return max(end - 65536, start) + found + 1
+            end = max(end - 65536, start)
+
+    return start
+
+
+
+## Reads the cache's meta.json, or returns 'end' if there is no cache yet
+def cache_info(sources):
+    import json
+    import os
+
+    meta_file = os.path.join(cache_folder(sources[0]), 'meta.json')
+    if not os.path.isfile(meta_file):
+        return 'end'
+    with open(meta_file, 'r') as f:
+        info = json.load(f)
+
+    return info
+
+
+
+## Checks a cache's stored key against the sources on disk
+## A source only gets hashed again when its mtime moved but its size did not
+def cache_valid(info, sources):
+    current = source_key(sources)
+    stored = info.get('sources', [])
+    if len(current) != len(stored):
+        return False
+    for n, (now, then) in enumerate(zip(current, stored)):
+        if now['file'] != then['file'] or now['size'] != then['size']:
+            return False
+        if now['mtime'] != then['mtime']:
+            segments = cache_segments(info['ingest']) if n == 0 and 'ingest' in info else None
+            if file_sha1(sources[n], segments) != then['sha1']:
+                return False
+            then['mtime'] = now['mtime']
+
+    return True
+
+
+
+## Segment ends the cached data file was hashed in, an unterminated last row is hashed on its own after the rest
+def cache_segments(ingest):
+    segments = ingest['segments']
+    if ingest.get('parsed', ingest['offset']) > ingest['offset']:
+        segments = segments + [ingest['parsed']]
+
+    return segments
+
+
+
+## Checks whether the data file only had rows added since it was cached (hdr file untouched)
+def cache_appendable(info, sources):
+    stored = info.get('sources', [])
+    if len(stored) != len(sources) or 'ingest' not in info:
+        return False
+    if len(sources) > 1 and not cache_valid({'sources': stored[1:]}, sources[1:]):
+        return False
+    now = source_key(sources[:1])[0]
+    offset = info['ingest']['offset']
+    if now['file'] != stored[0]['file'] or now['size'] < stored[0]['size'] or now['size'] <= offset:
+        return False
+
+    return edge_sha1(sources[0], offset) == info['ingest']['edge']
+
+
+
+## Maps one cached column back in, copy-on-write so the correction stages can still edit in place
+def map_column(path, dtype):
+    import os
+
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(path, dtype=dtype, mode='c')
+
+
+
+## Loads a data set from its cache folder, columns are memory-mapped rather than read
+## Returns 'end' if there is no cache or the sources changed since it was written
+## info is the cache's meta.json already checked against the sources, refresh if that check moved an mtime
+def load_cache(sources, info=None, refresh=False):
+    import datetime as dt
+    import os
+
+    if info is None:
+        info = cache_info(sources)
+        if info == 'end':
+            return 'end'
+        mtimes = [source['mtime'] for source in info['sources']]
+        if not cache_valid(info, sources):
+            print('Data set changed since it was cached')
+            return 'end'
+        refresh = [source['mtime'] for source in info['sources']] != mtimes
+    folder = cache_folder(sources[0])
+
+    ## Rebuild the Recording around the mapped columns
+    rec = Recording(map_column(os.path.join(folder, 'Time.bin'), np.int64))
+    for node in info['nodes']:
+        values = map_column(os.path.join(folder, node['file']), info.get('dtype', 'float64'))
+        if node.get('native') or 'phase' in node:
+            ingest = info.get('ingest', {})
+            phases = ingest.get('phases_parsed', ingest.get('phases', {})).get(str(node.get('node')),
+                                                                               [[0, node.get('phase', 0)]])
+            values = Channel(values, node['period'], phases)
+        rec[node['label']] = values
+        rec.meta[node['label']] = {'id': node['id'], 'unit': node['unit'], 'period': node['period'],
+                                   'node': node.get('node', len(rec.nodes))}
+    rec.gaps = np.fromfile(os.path.join(folder, 'gaps.bin'), dtype=gap_dtype)
+    if info['tz'] is not None:
+        rec.tz = dt.timezone(dt.timedelta(seconds=info['tz']))
+    rec.store = folder
+
+    ## Refresh the stored mtimes if the hash showed the data itself is unchanged
+    if refresh:
+        write_meta(folder, info)
+    print('Cached data set loaded')
+
+    return rec
+
+
+
+## Runs the vectorized ingest over bytes start..end of the data file, appending every block to the cache columns
+## An unterminated last row (end..size) is parsed & written as well, after the state at end has been kept
+## The bytes are hashed on the way through, carrying on the chain from digest
+## Returns the state at end (what the next append carries on from) with what was written after it counted in
+## 'pending' (rows), 'pending_columns' (values per node) & 'pending_gaps', the digest up to end & the digest
+## including the unterminated row
+def ingest_to_cache(folder, state, data_file, start, end, digest, block_rows=500000, size=None):
+    import copy
+    import hashlib
+    import os
+
+    labels = state['labels'][1:]
+    files = {'Time': open(os.path.join(folder, 'Time.bin'), 'ab'),
+             'gaps': open(os.path.join(folder, 'gaps.bin'), 'ab')}
+    for n, key in enumerate(labels):
+        files[key] = open(os.path.join(folder, 'node' + str(n) + '.bin'), 'ab')
+    sha1 = hashlib.sha1(digest.encode())
+
+    ## Each block's final samples & gaps are appended as they come
+    for block in csv_block_reader(data_file, block_rows, start, end):
+        sha1.update(block)
+        (block_dat, gaps) = ingest_block(block, state)
+        write_block(files, labels, block_dat, gaps, state['dtype'])
+
+    digest = sha1.hexdigest()
+    saved = copy.deepcopy(state)
+
+    ## A last row without its newline yet is parsed too, the next append redoes it from the state at end
+    ## Values written from here on are counted per column, Channels only hold their own samples
+    num_gaps = 0
+    written = [0] * len(labels)
+    parsed_digest = digest
+    if size is not None and size > end:
+        with open(data_file, 'rb') as f:
+            f.seek(end)
+            block = f.read(size - end)
+        parsed_digest = hashlib.sha1(digest.encode() + block).hexdigest()
+        (block_dat, gaps) = ingest_block(block, state)
+        write_block(files, labels, block_dat, gaps, state['dtype'])
+        num_gaps = len(gaps)
+        written = [count + len(block_dat[key]) for count, key in zip(written, labels)]
+
+    ## Samples still held back are written too, next time they are read back & redone
+    ## The held back tail is also kept as it was (float64) in pending.npz, so float32 columns
+    ## do not round it a second time
+    held = {'Time': saved['tail']['Time']}
+    held.update({'node' + str(n): saved['tail'][key] for n, key in enumerate(labels)})
+    block_dat = ingest_flush(state)
+    write_block(files, labels, block_dat, np.zeros(0, dtype=gap_dtype), state['dtype'])
+    saved['pending'] = state['emitted'] - saved['emitted']
+    saved['pending_columns'] = [count + len(block_dat[key]) for count, key in zip(written, labels)]
+    saved['pending_gaps'] = num_gaps
+    saved['phases_parsed'] = state['phases']
+    for f in files.values():
+        f.close()
+    np.savez(os.path.join(folder, 'pending.npz'), **held)
+
+    ## Pack into tuple & return
+    ingested = (saved, digest, parsed_digest)
+
+    return ingested
+
+
+
+## Appends one block of ingested arrays to the open cache column files
+def write_block(files, labels, block_dat, gaps, dtype=np.float64):
+    np.asarray(block_dat['Time'], dtype=np.int64).tofile(files['Time'])
+    gaps.tofile(files['gaps'])
+    for key in labels:
+        items = block_dat[key]
+        if isinstance(items, Channel):
+            items = items.values
+        np.asarray(items, dtype=dtype).tofile(files[key])
+
+
+
+## Writes meta.json through a temporary file, a reader never sees it half written
+def write_meta(folder, info):
+    import json
+    import os
+
+    meta_file = os.path.join(folder, 'meta.json')
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump(info, f)
+    os.replace(meta_file + '.tmp', meta_file)
+
+
+
+## Parser state as kept in meta.json, enough to carry on from the next new row
+## The data file is keyed on the bytes that were parsed (size), not on what it has grown to since
+def save_ingest_state(info, data_file, end, size, ingested):
+    (state, digest, parsed_digest) = ingested
+    ingest = info.get('ingest', {'segments': []})
+    ingest['offset'] = end
+    ingest['parsed'] = size
+    ingest['digest'] = digest
+    ingest['edge'] = edge_sha1(data_file, end)
+    ingest['segments'] = ingest['segments'] + [end]
+    ingest['last_line_time'] = state['last_line_time']
+    ingest['align_cont'] = list(state['align_cont'])
+    ingest['nodes_not_2ms'] = {str(node): interval for node, interval in state['nodes_not_2ms'].items()}
+    ingest['native'] = state['native']
+    ingest['phases'] = {str(node): phases for node, phases in state['phases'].items()}
+    ingest['phases_parsed'] = {str(node): phases for node, phases in state['phases_parsed'].items()}
+    ingest.pop('phase', None)
+    ingest['emitted'] = state['emitted']
+    ingest['pending'] = state['pending']
+    ingest['pending_columns'] = state['pending_columns']
+    ingest['pending_gaps'] = state['pending_gaps']
+    info['ingest'] = ingest
+    info['tz'] = None if state['tz'] is None else int(state['tz'].utcoffset(None).total_seconds())
+    info['sources'][0]['sha1'] = parsed_digest
+    info['sources'][0]['size'] = size
+
+
+
+## Parses a data set straight into its cache folder one block at a time, then maps it back in
+## Nothing bigger than a block is held in memory along the way
+def build_cache(hdr, data_file, offset, sources, native=False, block_rows=500000, dtype=np.float64):
+    import os
+    import shutil
+
+    ## Same set up as the in-memory path
+    (hdr_dat, nodes_not_2ms) = hdr_data(hdr)
+    (align_cont, file_dat) = align_plus_dat(hdr_dat, first_csv_line(data_file, offset))
+    labels = list(file_dat.nodes)
+
+    ## Written to a scratch folder first so a half written cache is never picked up
+    folder = cache_folder(sources[0])
+    scratch = folder + '.tmp'
+    shutil.rmtree(scratch, ignore_errors=True)
+    os.makedirs(scratch)
+
+    ## The hdr lines at the top of a cat file are part of the hash too
+    ## Everything up to the current size is parsed, an unterminated last row included
+    size = os.path.getsize(data_file)
+    end = last_row_end(data_file, offset, size)
+    state = ingest_state(file_dat, nodes_not_2ms, align_cont, native, dtype)
+    digest = file_sha1(data_file, [offset]) if offset > 0 else ''
+    ingested = ingest_to_cache(scratch, state, data_file, offset, end, digest, block_rows, size)
+
+    ## Node info, the source key & the parser state go in meta.json
+    nodes = []
+    for n, key in enumerate(labels):
+        node = {'label': key, 'file': 'node' + str(n) + '.bin'}
+        node.update(file_dat.meta[key])
+        if native and file_dat.meta[key]['period'] != 2:
+            node['native'] = True
+        nodes.append(node)
+    ## A hdr at the top of the file was hashed as its own segment, so it is the first one recorded
+    ## The data file's hash comes from the ingest, only a separate hdr file is hashed here
+    info = {'sources': source_key(sources[:1]) + source_key(sources[1:], with_hash=True), 'nodes': nodes,
+            'dtype': state['dtype'].name, 'native': bool(native), 'ingest': {'segments': [offset] if offset > 0 else []}}
+    save_ingest_state(info, data_file, end, size, ingested)
+    write_meta(scratch, info)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(scratch, folder)
+    print('Data set cached')
+
+    return load_cache(sources, info)
+
+
+
+## Parses only the rows added to a growing csv since it was cached & appends them to the cache
+## Running time, alignment & held back non-2ms samples all pick up where the last run stopped
+def append_cache(sources, info, block_rows=500000):
+    import datetime as dt
+    import os
+
+    data_file = sources[0]
+    folder = cache_folder(data_file)
+    ingest = info['ingest']
+    labels = [node['label'] for node in info['nodes']]
+
+    ## Put the running state back together
+    file_dat = Recording()
+    for n, node in enumerate(info['nodes']):
+        file_dat[node['label']] = []
+        file_dat.meta[node['label']] = {'node': node.get('node', n + 1)}
+    nodes_not_2ms = {int(node): interval for node, interval in ingest['nodes_not_2ms'].items()}
+    dtype = info.get('dtype', 'float64')
+    state = ingest_state(file_dat, nodes_not_2ms, tuple(ingest['align_cont']), ingest['native'], dtype)
+    state['last_line_time'] = ingest['last_line_time']
+    state['emitted'] = ingest['emitted']
+    ## Caches from before phases could change hold one phase per node
+    phases = ingest.get('phases', {node: [[0, phase]] for node, phase in ingest.get('phase', {}).items()})
+    state['phases'] = {int(node): node_phases for node, node_phases in phases.items()}
+    if info['tz'] is not None:
+        state['tz'] = dt.timezone(dt.timedelta(seconds=info['tz']))
+
+    ## Everything written after the last complete row (held back samples & an unterminated row) comes back
+    ## off the end of the columns, the held back tail is taken from pending.npz at its own precision (float64),
+    ## caches without it give the tail back as the columns stored it
+    pending = [ingest['pending']] + ingest.get('pending_columns', [ingest['pending']] * len(labels))
+    held = {}
+    if os.path.exists(os.path.join(folder, 'pending.npz')):
+        with np.load(os.path.join(folder, 'pending.npz')) as f:
+            held = dict(f)
+    columns = [('Time', 'Time.bin', np.int64)] + [(label, 'node' + str(n) + '.bin', dtype)
+                                                   for n, label in enumerate(labels)]
+    for (key, file, column_dtype), count in zip(columns, pending):
+        path = os.path.join(folder, file)
+        keep = os.path.getsize(path) - count * np.dtype(column_dtype).itemsize
+        items = held[file[:-4]] if file[:-4] in held else np.fromfile(path, dtype=column_dtype, offset=keep)
+        state['tail'][key] = items.astype(state['tail'][key].dtype)
+        os.truncate(path, keep)
+    gaps_file = os.path.join(folder, 'gaps.bin')
+    os.truncate(gaps_file, os.path.getsize(gaps_file) - ingest.get('pending_gaps', 0) * gap_dtype.itemsize)
+
+    ## Only the new bytes are parsed, the hash chain carries on from the last complete row
+    size = os.path.getsize(data_file)
+    end = last_row_end(data_file, ingest['offset'], size)
+    digest = ingest.get('digest', info['sources'][0]['sha1'])
+    ingested = ingest_to_cache(folder, state, data_file, ingest['offset'], end, digest, block_rows, size)
+    info['sources'] = source_key(sources[:1]) + info['sources'][1:]
+    save_ingest_state(info, data_file, end, size, ingested)
+    write_meta(folder, info)
+    print('New rows added to the cached data set')
+
+    return load_cache(sources, info)
+
+
+
+## Parses only the selected nodes of a data set into memory one block at a time, nothing is cached
+def parse_dataset(hdr, data_file, offset, nodes, native=False, block_rows=500000, dtype=np.float64):
+    (hdr_dat, nodes_not_2ms) = hdr_data(hdr)
+    (align_cont, file_dat) = align_plus_dat(hdr_dat, first_csv_line(data_file, offset), nodes)
+    blocks = csv_block_reader(data_file, block_rows, offset)
+    parts = list(time_out_stream(blocks, file_dat, nodes_not_2ms, align_cont, native, dtype))
+
+    ## Blocks are joined back up, Channels keep their period & phases (counted from the first row again)
+    if len(parts) == 0:
+        file_dat['Time'] = np.zeros(0, dtype=np.int64)
+        for key in file_dat.nodes:
+            file_dat[key] = np.zeros(0, dtype=dtype)
+        return file_dat
+    file_dat['Time'] = np.concatenate([part['Time'] for part in parts])
+    for key in file_dat.nodes:
+        if isinstance(parts[0][key], Channel):
+            last_row = len(file_dat['Time']) - len(parts[-1]['Time'])
+            file_dat[key] = Channel(np.concatenate([part[key].values for part in parts]), parts[0][key].period,
+                                    [[row + last_row, phase] for row, phase in parts[-1][key].phases])
+        else:
+            file_dat[key] = np.concatenate([part[key] for part in parts])
+    file_dat.gaps = np.concatenate([part.gaps for part in parts])
+    file_dat.tz = parts[-1].tz
+
+    return file_dat
+
+
+
+## Opens a data set through its cache, parsing (& caching) it only if there is no valid cache
+## A csv that has only grown since is brought up to date by parsing just the new rows
+## nodes is an optional set of node labels or ids to open, taken from the cache if there is one,
+## otherwise only those columns are parsed (& not cached)
+## dtype np.float32 keeps node values in single precision, a cache stored at the other precision is rebuilt
+## A cache is rebuilt the same way when native asks for the other layout of the non-2ms nodes
+## native stays opt-in, the 2ms layout is time_out's fill (the loop version's values, 0.5 where it left a blank)
+## while a native grid interpolates between the recorded samples, so printed & plotted values would change
+def open_dataset(dataset, native=False, use_cache=True, nodes=None, dtype=np.float64):
+    import os
+
+    located = file_locator(dataset)
+    if located == 'end':
+        return 'end'
+    (hdr, data_file, offset) = located
+
+    ## A separate hdr file is part of the key too
+    sources = [data_file]
+    if offset == 0 and os.path.isfile(dataset + '.hdr'):
+        sources.append(dataset + '.hdr')
+
+    if use_cache:
+        info = cache_info(sources)
+        rec = 'end'
+        if info != 'end' and info.get('dtype', 'float64') != np.dtype(dtype).name:
+            print('Data set was cached at', info.get('dtype', 'float64'), 'precision')
+        ## Caches from before native was stored have it in the parser state
+        elif info != 'end' and info.get('native', info.get('ingest', {}).get('native', False)) != bool(native):
+            print('Data set was cached', 'without' if native else 'with', 'native non-2ms nodes')
+        elif info != 'end':
+            ## Checked once here, a touched source is hashed a single time
+            mtimes = [source['mtime'] for source in info['sources']]
+            if cache_valid(info, sources):
+                rec = load_cache(sources, info, [source['mtime'] for source in info['sources']] != mtimes)
+            elif cache_appendable(info, sources):
+                rec = append_cache(sources, info)
+            else:
+                print('Data set changed since it was cached')
+        if rec != 'end':
+            return rec.with_nodes({key: items for key, items in rec.nodes.items()
+                                   if wanted_node(key, rec.meta[key]['id'], nodes)})
+
+    if nodes is not None:
+        return parse_dataset(hdr, data_file, offset, nodes, native, dtype=dtype)
+
+    return build_cache(hdr, data_file, offset, sources, native, dtype=dtype)
+
+
+
+## Sparse time index of a csv: time & byte offset of every Nth timestamped row
+## Kept in a small sidecar file (<data file>.idx) so a time window can be read without parsing the rest
+def build_time_index(data_file, offset=0, every=1000, block_rows=500000):
+    import os
+
+    times = []
+    offsets = []
+    count = 0
+    pos = offset
+    tz = None
+
+    for block in csv_block_reader(data_file, block_rows, offset):
+        tokens = csv_tokenizer(block)
+        (buf, row_starts, row_ends, commas, first_comma, num_fields) = tokens
+
+        ## Rows that do not start with a comma carry a timestamp, only every Nth is kept
+        stamped = np.flatnonzero(buf[row_starts] != 44)
+        keep = stamped[(count + np.arange(len(stamped))) % every == 0]
+        count += len(stamped)
+        picked = (buf, row_starts[keep], row_ends[keep], commas, first_comma[keep], num_fields[keep])
+        (stamps, blank) = column_field(picked, 0)
+        (stamp_times, tz) = decode_timestamps(stamps, tz)
+        times.append(stamp_times)
+        offsets.append(pos + row_starts[keep])
+        pos += len(block)
+
+    ## Saved with the file size & mtime it was built from
+    stat = os.stat(data_file)
+    index = {'time': np.concatenate(times + [np.zeros(0, dtype=np.int64)]),
+             'offset': np.concatenate(offsets + [np.zeros(0, dtype=np.int64)]),
+             'key': np.array([stat.st_size, stat.st_mtime_ns, offset, every], dtype=np.int64)}
+    with open(data_file + '.idx', 'wb') as f:
+        np.savez(f, **index)
+    print('Time index built')
+
+    return index
+
+
+
+## Loads a csv's time index, rebuilding it if the csv changed since it was built
+def load_time_index(data_file, offset=0, every=1000):
+    import os
+
+    if os.path.isfile(data_file + '.idx'):
+        with np.load(data_file + '.idx') as saved:
+            index = {key: saved[key] for key in saved.files}
+        stat = os.stat(data_file)
+        if list(index['key'][:3]) == [stat.st_size, stat.st_mtime_ns, offset]:
+            return index
+
+    return build_time_index(data_file, offset, every)
+
+
+
+## Epoch ns from an epoch ns int, an aware datetime or a timestamp string in the export format
+def to_ns(when):
+    import datetime as dt
+
+    if isinstance(when, dt.datetime):
+        return (when - dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)) // dt.timedelta(microseconds=1) * 1000
+    if isinstance(when, (str, bytes)):
+        when = when.encode() if isinstance(when, str) else when
+        return int(decode_timestamps(np.array([when]))[0][0])
+
+    return int(when)
+
+
+
+## Reads only the samples from start up to (not including) end of a data set
+## Seeks through the time index to just before the window & parses from there, with the same
+## gap, alignment & non-2ms handling as time_out
+def read_window(dataset, start, end, every=1000, block_rows=50000, nodes=None, dtype=np.float64):
+    located = file_locator(dataset)
+    if located == 'end':
+        return 'end'
+    (hdr, data_file, offset) = located
+    start = to_ns(start)
+    end = to_ns(end)
+
+    ## Alignment is always judged from the first csv row of the file
+    (hdr_dat, nodes_not_2ms) = hdr_data(hdr)
+    (align_cont, file_dat) = align_plus_dat(hdr_dat, first_csv_line(data_file, offset), nodes)
+
+    ## Non-2ms fills reach half the node's period back from each of its samples
+    ## Parsing starts at an indexed row at least that far (plus one) before the window & runs at least that far
+    ## past its end, so fills running into the window from either side are complete
+    index = load_time_index(data_file, offset, every)
+    if len(index['time']) == 0:
+        return file_dat
+    margin = (max([interval // 2 for interval in nodes_not_2ms.values()] + [0]) + 1) * 2000000
+    entry = int(np.searchsorted(np.maximum.accumulate(index['time']), start - margin, side='right')) - 2
+    entry = max(entry, 0)
+
+    ## Parse blocks until the window's end (& margin) has gone past
+    state = ingest_state(file_dat, nodes_not_2ms, align_cont, dtype=dtype)
+    parts = []
+    gaps = []
+    for block in csv_block_reader(data_file, block_rows, int(index['offset'][entry])):
+        (block_dat, block_gaps) = ingest_block(block, state)
+        parts.append(block_dat)
+        gaps.append(block_gaps)
+        if state['last_line_time'] is not None and state['last_line_time'] >= end + margin:
+            break
+    parts.append(ingest_flush(state))
+
+    ## Keep the samples inside the window
+    times = np.concatenate([part['Time'] for part in parts])
+    inside = (times >= start) & (times < end)
+    file_dat['Time'] = times[inside]
+    for key in file_dat.nodes:
+        file_dat[key] = np.concatenate([part[key] for part in parts])[inside]
+    gaps = np.concatenate(gaps + [np.zeros(0, dtype=gap_dtype)])
+    file_dat.gaps = gaps[(gaps['start'] + gaps['duration'] > start) & (gaps['start'] < end)]
+    file_dat.tz = state['tz']
+
+    return file_dat
+
+
+
 ## Data processing, printing, and plotting options
 def plot_out(final_dat, dataset):
     import plotly
@@ -389,12 +2170,14 @@ def plot_out(final_dat, dataset):
             print_dict(data_pref, out)
         print('\nData has been printed to the data set folder')
 
-    ## Plotting data begins
+    ## Plotting data begins, every 4th point is read one window at a time
     print('\nPlotting points')
+    window = 1000000
     for key, items in data_pref.items():
         if key != 'Time':
-            fig = px.line(x=data_pref['Time'][0::4],
-                          y=data_pref[key][0::4],
+            points = range(0, len(data_pref['Time']), window)
+            fig = px.line(x=np.concatenate([data_pref.local_time(start, start + window)[0::4] for start in points]),
+                          y=np.concatenate([data_pref.grid(key, start, start + window)[0::4] for start in points]),
                           labels={'x': '', 'y': key})
             items = tuple()
             fig.update_layout(title_text=title + ' data from ' + dataset + ', node ' + key, showlegend=False)
@@ -425,267 +2208,885 @@ def new_folder():
         
 
 ## Data corrections occur here
-def corrected_dict(dictionary):
+## Returns a Recording on the same time base with the corrected node values
+## A Recording mapped from the cache is corrected window by window, see corrected_store
+## workers above 1 spreads the nodes over a process pool, see corrected_parallel
+def corrected_dict(dictionary, window=1000000, overlap=5000, workers=1):
+    if dictionary.store is not None:
+        return corrected_store(dictionary, window, overlap)
+    if workers > 1 and len(dictionary.nodes) > 1:
+        return corrected_parallel(dictionary, workers)
+    if len(dictionary.nodes) == 0:
+        return dictionary.with_nodes({})
+
+    ## Sample rate is the same for every node, worked out once from the time base
+    sample_rate = round(dictionary.sample_rate, 3)
+
+    ## Every node is a row of one (nodes x samples) array, so the filtering stages are set up once for them all
+    keys = list(dictionary.nodes)
+    rows = correct_node([dictionary.grid(key) for key in keys], sample_rate)
     corrected = {}
+    for key, row in zip(keys, rows):
+        corrected[key] = row
+        print('node', key, 'corrected')
+    return dictionary.with_nodes(corrected)
 
-    ## Calls HeartPy functions to remove baseline & HRVY peak reductions & inversion
-    for key, items in dictionary.items():
-        if key == 'Time':
-            corrected['Time'] = tuple(dictionary['Time'])
-        else:
-            sample_rate = round(get_samplerate_datetime(dictionary['Time'], timeformat='%Y-%m-%d %H:%M:%S.%f%z'), 3)
-            corrected[key] = tuple(smooth_signal(
-                tall_peak_reduct(
-                    remove_baseline_wander(
-                        flat_peak_reduct(
-                            dictionary[key]
-                        )  # for flat_peak_reduct
-                        , sample_rate)  # for remove_baseline_wander
-                )  # for tall_peak_reduct
-                , sample_rate, window_length=16, polyorder=3)  # for smooth_signal
-            )
-            print('node', key, 'corrected')
+
+
+## Corrections for one node's values on the 2ms time base, every node goes through the same steps
+## Several nodes can be passed as rows of a (nodes x samples) array, the peak reductions go row by row
+## & the filtering runs over all the rows at once
+## float32 values are corrected in float32, anything else in float64
+def correct_node(values, sample_rate):
+    rows = np.array(values, dtype=value_dtype(values))
+    single = rows.ndim == 1
+    if single:
+        rows = rows.reshape(1, -1)
+
+    ## HRVY flat peak reduction, rows are reduced in place
+    for row in rows:
+        flat_peak_reduct(row)
+
+    ## Calls HeartPy function to remove baseline
+    rows = remove_baseline_wander(rows, sample_rate, out=rows)
+
+    ## HRVY tall peak reduction & inversion, in place again
+    for row in rows:
+        tall_peak_reduct(row)
+
+    ## Calls HeartPy function to smooth, in place
+    corrected = smooth_signal(rows, sample_rate, window_length=16, polyorder=3, out=rows)
+
+    ## A single node comes back 1-D, as it was passed in
+    if single:
+        return corrected[0]
     return corrected
 
 
-  
+
+## Precision node values are corrected & stored in, float32 stays float32 & everything else is float64
+def value_dtype(values):
+    if isinstance(values, np.ndarray):
+        return np.float32 if values.dtype == np.float32 else np.float64
+    if isinstance(values, (list, tuple)) and len(values) > 0 and isinstance(values[0], np.ndarray):
+        return np.float32 if all(value.dtype == np.float32 for value in values) else np.float64
+    return np.float64
+
+
+
+## Parallel version of corrected_dict, nodes are independent so each one goes to a worker of a process pool
+## Node values are handed over & back in shared memory blocks rather than pickled
+def corrected_parallel(dictionary, workers):
+    from multiprocessing import Pool, shared_memory
+
+    sample_rate = round(dictionary.sample_rate, 3)
+    corrected = {}
+    blocks = {}
+    jobs = []
+    try:
+        ## One block per node, filled with the node's values on the 2ms time base
+        for key in dictionary.nodes:
+            values = dictionary.grid(key)
+            values = np.asarray(values, dtype=value_dtype(values))
+            blocks[key] = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 8))
+            np.ndarray(len(values), dtype=values.dtype, buffer=blocks[key].buf)[:] = values
+            jobs.append((blocks[key].name, len(values), sample_rate, values.dtype.name))
+
+        ## Workers correct the values in place, nodes come back in order
+        with Pool(min(workers, len(jobs))) as pool:
+            for key, done in zip(blocks, pool.imap(correct_shared, jobs)):
+                print('node', key, 'corrected')
+
+        for key, job in zip(blocks, jobs):
+            corrected[key] = np.array(np.ndarray(job[1], dtype=job[3], buffer=blocks[key].buf))
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+    return dictionary.with_nodes(corrected)
+
+
+
+## Worker side of corrected_parallel, corrects one node's shared memory block in place
+def correct_shared(job):
+    from multiprocessing import shared_memory
+
+    (name, num_rows, sample_rate, dtype) = job
+    block = shared_memory.SharedMemory(name=name)
+    values = np.ndarray(num_rows, dtype=dtype, buffer=block.buf)
+    values[:] = correct_node(values, sample_rate)
+    del values
+    block.close()
+
+    return name
+
+
+
+## Windows of rows start..stop, with overlap rows either side (lo..hi) to work them out from
+def window_bounds(num_rows, window, overlap=0):
+    for start in range(0, num_rows, window):
+        stop = min(start + window, num_rows)
+        yield (start, stop, max(start - overlap, 0), min(stop + overlap, num_rows))
+
+
+
+## Out-of-core version of corrected_dict for Recordings mapped from the cache
+## Each node is corrected window by window into <cache folder>/corrected, never more than a window in memory
+## Peak reductions & smoothing are local, worked out on the window plus overlap rows either side
+## Baseline filtering runs over the whole node in two passes (sosfiltfilt_blocks), the inversion vote & flip
+## take in the whole node too, so the result follows the in-memory path
+def corrected_store(dictionary, window=1000000, overlap=5000):
+    import os
+    import shutil
+
+    num_rows = len(dictionary['Time'])
+    sample_rate = round(dictionary.sample_rate, 3)
+
+    ## Written to a scratch folder first, then swapped in for the last corrected data
+    folder = os.path.join(dictionary.store, 'corrected')
+    scratch = folder + '.tmp'
+    shutil.rmtree(scratch, ignore_errors=True)
+    os.makedirs(scratch)
+
+    files = {}
+    dtypes = {}
+    for n, key in enumerate(dictionary.nodes):
+        ## Corrected at the precision the node is stored in
+        files[key] = 'node' + str(n) + '.bin'
+        dtypes[key] = value_dtype(dictionary.grid(key, 0, 1))
+        stage = np.memmap(os.path.join(scratch, 'stage.bin'), dtype=dtypes[key], mode='w+', shape=(num_rows,))
+        out = np.memmap(os.path.join(scratch, files[key]), dtype=dtypes[key], mode='w+', shape=(num_rows,))
+
+        ## Flat peak reduction, then baseline wander removed from the whole node
+        ## as second-order sections streamed a window at a time, see filter_signal
+        for (start, stop, lo, hi) in window_bounds(num_rows, window, overlap):
+            section = np.array(dictionary.grid(key, lo, hi), dtype=dtypes[key])
+            stage[start:stop] = flat_peak_reduct(section)[start - lo:stop - lo]
+        remove_baseline_wander(stage, sample_rate, block=window, out=stage)
+
+        ## Tall peak reduction & smoothing, inversion guesses & range collected for the whole node
+        inv_guesses = []
+        low = np.inf
+        high = -np.inf
+        for (start, stop, lo, hi) in window_bounds(num_rows, window, overlap):
+            guesses = []
+            section = tall_peak_reduct(np.array(stage[lo:hi]), guesses)
+            inv_guesses.extend(guess for end, guess in guesses if start <= lo + end < stop)
+            low = min(low, section[start - lo:stop - lo].min())
+            high = max(high, section[start - lo:stop - lo].max())
+            out[start:stop] = smooth_signal(section, sample_rate, window_length=16, polyorder=3)[start - lo:stop - lo]
+
+        ## Flipping keeps the range, so it is the same as flipping before smoothing
+        if inverted_vote(inv_guesses):
+            print(' Inverted signal detected')
+            print(' Un-inverting data')
+            for (start, stop, lo, hi) in window_bounds(num_rows, window):
+                np.subtract(low + high, out[start:stop], out=out[start:stop])
+        out.flush()
+        del stage, out
+        print('node', key, 'corrected')
+    os.remove(os.path.join(scratch, 'stage.bin'))
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(scratch, folder)
+
+    ## Mapped back in on the same time base
+    corrected = {key: map_column(os.path.join(folder, file), dtypes[key]) for key, file in files.items()}
+    rec = dictionary.with_nodes(corrected)
+    rec.store = folder
+
+    return rec
+
+
+
+## Causal counterpart of corrected_dict for live monitoring, fed small packets of samples as they arrive
+## Every node keeps its state from packet to packet: flat & tall peak reduction (LiveReduction), the baseline
+## notch as second-order sections with its zi, then smoothing (LiveSmoother)
+## Samples come out a fixed delay after they went in, 2 * hold samples for the reductions plus half the
+## smoothing window
+class LiveCorrector:
+    def __init__(self, labels, sample_rate, hold=50, window_length=16, polyorder=3):
+        if window_length % 2 == 0:
+            window_length += 1
+        self.sample_rate = sample_rate
+        self.sos = filter_coefficients(0.05, sample_rate, filtertype='notch', sos=True)
+        self.nodes = {}
+        for label in labels:
+            self.nodes[label] = {'flat': LiveReduction(flat=True, hold=hold),
+                                 'tall': LiveReduction(flat=False, hold=hold),
+                                 'smooth': LiveSmoother(window_length, polyorder),
+                                 'zi': None,
+                                 'low': np.inf,
+                                 'high': -np.inf,
+                                 'inverted': False}
+        self.times = np.zeros(0, dtype=np.int64)
+        self.meta = {}
+        self.tz = None
+        self.samples_in = 0
+        self.samples_out = 0
+        self.worst = 0.0
+
+    ## Takes one packet (a Recording, e.g. a block from time_out_stream) & returns the samples that are now final
+    ## as a Recording, with the packet's latency: compute time & how far behind the newest sample the output is
+    def push(self, packet):
+        import time
+
+        started = time.perf_counter()
+        corrected = {}
+        for label, node in self.nodes.items():
+            values = np.asarray(packet.grid(label), dtype=np.float64)
+            corrected[label] = self.correct(node, values, flush=False)
+        self.times = np.concatenate((self.times, packet['Time']))
+        self.samples_in += len(packet['Time'])
+        self.meta = packet.meta
+        self.tz = packet.tz
+
+        return self.emit(corrected, time.perf_counter() - started)
+
+    ## Hands back every sample still held, once the stream has ended
+    def flush(self):
+        import time
+
+        started = time.perf_counter()
+        corrected = {}
+        for label, node in self.nodes.items():
+            corrected[label] = self.correct(node, np.zeros(0), flush=True)
+
+        return self.emit(corrected, time.perf_counter() - started)
+
+    ## One node's samples through the chain, every stage holds back what it can still change
+    def correct(self, node, values, flush):
+        flat = node['flat'].push(values, flush)
+
+        ## Baseline notch runs causally, started from the steady state of the first sample
+        if node['zi'] is None and len(flat) > 0:
+            node['zi'] = sosfilt_zi(self.sos) * flat[0]
+        if len(flat) > 0:
+            (flat, node['zi']) = sosfilt(self.sos, flat, zi=node['zi'])
+        tall = node['tall'].push(flat, flush)
+
+        ## Once the inversion vote says so, flip within the range seen so far
+        if len(tall) > 0:
+            node['low'] = min(node['low'], tall.min())
+            node['high'] = max(node['high'], tall.max())
+        if not node['inverted'] and inverted_vote(node['tall'].guesses):
+            print(' Inverted signal detected')
+            print(' Un-inverting data')
+            node['inverted'] = True
+        if node['inverted']:
+            tall = (node['low'] + node['high']) - tall
+
+        return node['smooth'].push(tall, flush)
+
+    ## Packs the final samples of every node with their times
+    def emit(self, corrected, compute):
+        num_out = min(len(values) for values in corrected.values()) if len(corrected) > 0 else 0
+        times = self.times[:num_out]
+        self.times = self.times[num_out:]
+        self.samples_out += num_out
+        rec = Recording(times, corrected, self.meta, tz=self.tz)
+
+        ## Delay is how many samples in are not out yet, at the sample period
+        delay = (self.samples_in - self.samples_out) * 1000 / self.sample_rate
+        self.worst = max(self.worst, delay + compute * 1000)
+        latency = {'samples_in': self.samples_in,
+                   'samples_out': self.samples_out,
+                   'delay_ms': delay,
+                   'compute_ms': compute * 1000,
+                   'latency_ms': delay + compute * 1000,
+                   'worst_ms': self.worst}
+
+        ## Pack into tuple & return
+        live_out = (rec, latency)
+
+        return live_out
+
+
+
+## Flat (flat=True) or tall peak reduction one packet at a time, the same steps as flat_peak_reduct &
+## tall_peak_reduct take on each sample
+## Samples are held back hold samples, after that they are final: a segment reaching further back is only
+## reduced from there on
+## The tall reduction's inversion guesses build up in guesses
+class LiveReduction:
+    def __init__(self, flat=True, hold=50):
+        self.flat = flat
+        (self.steep_slope, self.not_flat, self.scale_max) = (0.5, 0.05, 3) if flat else (0.3, 0.01, 2)
+        self.hold = hold
+        self.values = np.zeros(0)
+        self.offset = 0
+        self.emitted = 0
+        self.i_start = None
+        self.v_start = None
+        self.ss_check1 = 'N'
+        self.ss_check2 = 'N'
+        self.ss_1 = 0
+        self.rep_val = None
+        self.rv_start = None
+        self.samp_start = None
+        self.ss_v = None
+        self.guesses = []
+
+    ## Takes the next samples & returns those that are final, all of them if flush
+    def push(self, values, flush=False):
+        first = self.offset + len(self.values)
+        self.values = np.concatenate((self.values, values))
+        for i in range(first, first + len(values)):
+            self.step(i)
+
+        ## Final samples go out, the last 1000 are kept for the inversion check to look back on
+        end = self.offset + len(self.values)
+        upto = end if flush else max(end - self.hold, self.emitted)
+        final = self.values[self.emitted - self.offset:upto - self.offset].copy()
+        self.emitted = upto
+        keep = max(self.emitted - 1001, self.offset)
+        self.values = self.values[keep - self.offset:]
+        self.offset = keep
+
+        return final
+
+    ## One sample, i counts from the start of the stream
+    def step(self, i):
+        values = self.values
+        off = self.offset
+        v = values[i - off]
+
+        ## If segement of repeated values over 20ms is found, reduce to baseline 0.5
+        if self.flat:
+            if i > 0 and self.rep_val is None and v != 0.5 and v == values[i - 1 - off]:
+                self.rep_val = v
+                self.rv_start = i - 1
+            if self.rep_val is not None and v != self.rep_val:
+                if i - self.rv_start >= 10 and self.ss_check1 == 'N':
+                    values[max(self.rv_start, self.emitted) - off:i - off] = 0.5
+                self.rep_val = None
+        if i == 0:
+            return
+
+        ## If unrealistic tall peaks or steep slopes found, reduce
+        slope = v - values[i - 1 - off]
+        if self.i_start is None and abs(slope) >= self.not_flat:
+            self.i_start = i - 1
+            self.v_start = values[i - 1 - off]
+        if abs(slope) >= self.steep_slope:
+            self.ss_check1 = 'Y'
+            self.ss_1 = slope
+        if slope != 0 and self.ss_1 != 0 and self.ss_check1 == 'Y' and abs(slope) >= self.not_flat and (
+                slope > 0) != (self.ss_1 > 0):
+            self.ss_check2 = 'Y'
+
+        ## If not a steep slope, reset values for next iteration
+        if self.i_start is not None and self.ss_check1 == 'N' and i - self.i_start >= 50:
+            self.i_start = None
+            self.v_start = None
+            self.ss_check1 = 'N'
+            self.ss_check2 = 'N'
+
+        ## If it is a steep slope, reduce segment, as far back as samples are still held
+        if self.flat:
+            settled = slope != 0 and abs(slope) <= self.not_flat and self.rep_val is None
+        else:
+            settled = abs(slope) <= self.not_flat
+        if self.i_start is not None and self.ss_check2 == 'Y' and settled:
+            if self.flat and self.i_start == 0:
+                self.v_start = v
+            len_ss = i - self.i_start
+            step = (v - self.v_start) / len_ss
+            most_dif_val = np.max(np.abs(values[max(self.i_start, off) - off:i - off] - self.v_start))
+            if most_dif_val >= self.scale_max:
+                fill = np.full(len_ss, step)
+                fill[0] = self.v_start
+                cut = max(self.i_start, self.emitted)
+                values[cut - off:i - off] = np.cumsum(fill)[cut - self.i_start:]
+            self.i_start = None
+            self.v_start = None
+            self.ss_check1 = 'N'
+            self.ss_check2 = 'N'
+            self.ss_1 = 0
+
+        ##Detection of inverted signal by taking samples (1000 datapoints) of normal sections of data
+        if not self.flat:
+            if self.samp_start is None and slope <= self.not_flat:
+                self.samp_start = i - 1
+                self.ss_v = v
+            if self.samp_start is not None and (slope >= self.steep_slope or abs(v - self.ss_v) > self.scale_max):
+                self.samp_start = None
+            if self.samp_start is not None and i - self.samp_start == 1000:
+                self.guesses.extend(guess for end, guess in selection_guesses(
+                    values, [(self.samp_start - off, i - off)], []))
+                self.samp_start = None
+
+
+
+## Savitzky-Golay smoothing one packet at a time, each sample waits for the half window after it
+## The first & last half windows are fitted like savgol_filter's 'interp' mode
+class LiveSmoother:
+    def __init__(self, window_length=17, polyorder=3):
+        self.window_length = window_length
+        self.polyorder = polyorder
+        (self.coeffs, self.left, self.right) = savgol_kernel(window_length, polyorder)
+        self.values = np.zeros(0)
+        self.offset = 0
+        self.done = 0
+
+    ## Takes the next samples & returns those that are smoothed, all of them if flush
+    def push(self, values, flush=False):
+        window = self.window_length
+        half = window // 2
+        self.values = np.concatenate((self.values, values))
+        end = self.offset + len(self.values)
+        smoothed = []
+
+        ## Too few samples for a single window go out as they are
+        if flush and end < window:
+            smoothed.append(self.values[self.done - self.offset:])
+            self.done = end
+        elif end >= window:
+            if self.done == 0:
+                smoothed.append(self.values[:window] @ self.left.T)
+                self.done = half
+            centers = np.convolve(self.values, self.coeffs, mode='valid')
+            smoothed.append(centers[self.done - self.offset - half:])
+            self.done = end - half
+            if flush:
+                smoothed.append(self.values[-window:] @ self.right.T)
+                self.done = end
+
+        ## A window's worth is kept to carry on from
+        keep = max(end - window, self.offset)
+        self.values = self.values[keep - self.offset:]
+        self.offset = keep
+
+        return np.concatenate(smoothed) if len(smoothed) > 0 else np.zeros(0)
+
+
+
 ## Reduces long flat peaks
+## Same steps as going through the samples one at a time, but only samples where the state can change are visited
+## Slopes & repeated value runs are found for the whole node up front, segments are refilled by slice
 def flat_peak_reduct(lst):
-    rep_val = None
-
     steep_slope = 0.5
     not_flat = 0.05
     i_start = None
     v_start = None
-    i_end = None
-    v_end = None
     ss_check1 = 'N'
     ss_check2 = 'N'
     scale_max = 3
     ss_1 = 0
 
-    for i, v in enumerate(lst):
+    ## Float arrays are reduced in place, anything else is copied into one
+    if isinstance(lst, np.ndarray) and lst.dtype.kind == 'f':
+        values = lst
+    else:
+        values = np.array(lst, dtype=np.float64)
+    num_vals = len(values)
+    if num_vals < 2:
+        return lst
+
+    ## Slope into each sample, indices of the slopes each state waits on
+    slopes = np.diff(values)
+    magnitudes = np.abs(slopes)
+    not_flats = np.flatnonzero(magnitudes >= not_flat) + 1
+    steeps = np.flatnonzero(magnitudes >= steep_slope) + 1
+    rises = np.flatnonzero(slopes >= not_flat) + 1
+    falls = np.flatnonzero(slopes <= -not_flat) + 1
+    flattens = np.flatnonzero((slopes != 0) & (magnitudes <= not_flat)) + 1
+    del magnitudes
+
+    ## Segments of repeated values (other than 0.5) over 20ms, looked up by the sample that ends them
+    del slopes
+    changes = np.flatnonzero(values[1:] != values[:-1]) + 1
+    run_starts = np.concatenate(([0], changes))
+    run_ends = np.concatenate((changes, [num_vals]))
+    long_runs = (run_ends - run_starts >= 10) & (values[run_starts] != 0.5) & (run_ends < num_vals)
+    rep_ends = run_ends[long_runs]
+    rep_starts = dict(zip(rep_ends.tolist(), run_starts[long_runs].tolist()))
+
+    i = 1
+    while True:
+        ## Next sample where anything can happen, nothing changes on the samples in between
+        if i_start is None:
+            i_next = next_index(not_flats, i, num_vals)
+        elif ss_check1 == 'N':
+            i_next = min(next_index(steeps, i, num_vals), i_start + 50)
+        elif ss_check2 == 'N':
+            i_next = min(next_index(steeps, i, num_vals), next_index(falls if ss_1 > 0 else rises, i, num_vals))
+        else:
+            i_next = next_index(flattens, i, num_vals)
+        i = min(i_next, next_index(rep_ends, i, num_vals))
+        if i >= num_vals:
+            break
+        v = values[i]
 
         ## If segement of repeated values over 20ms is found, reduce to baseline 0.5
-        if i > 0 and rep_val is None and v != 0.5 and v == lst[i - 1]:
-            rep_val = v
-            rv_start = i - 1
-        if rep_val is not None and v != rep_val:
-            rv_end = i
-            len_rep_val = rv_end - rv_start
-            if len_rep_val >= 10 and ss_check1 == 'N':
-                lst[rv_start:rv_end] = [0.5] * len_rep_val
-            rep_val = None
+        if i in rep_starts and ss_check1 == 'N':
+            values[rep_starts[i]:i] = 0.5
 
         ## If unrealistic tall peaks or steep slopes found, reduce
-        if i > 0:
-            slope = v - lst[i - 1]
-            if i_start == None and abs(slope) >= not_flat:
-                i_start = i - 1
-                v_start = lst[i - 1]
-            if abs(slope) >= steep_slope:
-                ss_check1 = 'Y'
-                ss_1 = slope
-                if i_start == None:
-                    i_start = i - 1
-                    v_start = lst[i - 1]
-            if slope != 0 and ss_1 != 0 and ss_check1 == 'Y' and abs(slope) >= not_flat and int(
-                    slope / abs(slope)) == int(ss_1 / abs(ss_1) * (-1)):
-                ss_check2 = 'Y'
-
-            ## If not a steep slope, reset values for next iteration
-            if i_start != None and ss_check1 == 'N' and i - i_start >= 50:
-                i_start = None
-                v_start = None
-                i_end = None
-                v_end = None
-                ss_check1 = 'N'
-                ss_check2 = 'N'
-
-            ## If it is a steep slope, reduce segment
-            if i_start != None and ss_check2 == 'Y' and slope != 0 and abs(slope) <= not_flat and rep_val == None:
-                if i_start == 0:
-                    v_start = v
-                i_end = i
-                v_end = v
-                len_ss = i_end - i_start
-                fill = []
-                v_dif = v_end - v_start
-                step = v_dif / len_ss
-                val = v_start
-                vals = lst[i_start:i_end]
-                most_dif_val = max(map(lambda x: abs(x - v_start), vals))
-                if most_dif_val >= scale_max:
-                    for gap in range(len_ss):
-                        fill.append(val)
-                        val += step
-                    lst[i_start:i_end] = fill
-
-                ## Clears values for next iteration
-                i_start = None
-                v_start = None
-                i_end = None
-                v_end = None
-                ss_check1 = 'N'
-                ss_check2 = 'N'
-                ss_1 = 0
-
-    return lst
+        slope = v - values[i - 1]
+        if i_start is None and abs(slope) >= not_flat:
+            i_start = i - 1
+            v_start = values[i - 1]
+        if abs(slope) >= steep_slope:
+            ss_check1 = 'Y'
+            ss_1 = slope
+        if slope != 0 and ss_1 != 0 and ss_check1 == 'Y' and abs(slope) >= not_flat and (slope > 0) != (ss_1 > 0):
+            ss_check2 = 'Y'
+
+        ## If not a steep slope, reset values for next iteration
+        if i_start is not None and ss_check1 == 'N' and i - i_start >= 50:
+            i_start = None
+            v_start = None
+            ss_check1 = 'N'
+            ss_check2 = 'N'
+
+        ## If it is a steep slope, reduce segment
+        ## Refill adds the step on one sample at a time (cumsum), same as the running total it replaces
+        if i_start is not None and ss_check2 == 'Y' and slope != 0 and abs(slope) <= not_flat:
+            if i_start == 0:
+                v_start = v
+            len_ss = i - i_start
+            step = (v - v_start) / len_ss
+            most_dif_val = np.max(np.abs(values[i_start:i] - v_start))
+            if most_dif_val >= scale_max:
+                fill = np.full(len_ss, step, dtype=values.dtype)
+                fill[0] = v_start
+                values[i_start:i] = np.cumsum(fill)
+
+            ## Clears values for next iteration
+            i_start = None
+            v_start = None
+            ss_check1 = 'N'
+            ss_check2 = 'N'
+            ss_1 = 0
+        i += 1
+
+    return values_out(lst, values)
+
+
+
+## First of a sorted array of sample indices at or after i, num_vals if there is none
+def next_index(indices, i, num_vals):
+    pos = indices.searchsorted(i)
+    if pos < len(indices):
+        return int(indices[pos])
+
+    return num_vals
 
 
   
 ## Removes unrealistic point and checks for data inversion
-def tall_peak_reduct(lst):
+## Steep slope segments are found visiting only samples where the state can change, as in flat_peak_reduct
+## Inversion is checked on clean selections sampled across the node until the vote is settled at the given
+## confidence (see sampled_inversion), full_scan (or a vote that never settles) votes on every clean selection
+## If a list is passed for inv_guesses, the guesses for every clean selection go into it as (sample end, guess)
+## & nothing is flipped, the caller decides for the whole record
+def tall_peak_reduct(lst, inv_guesses=None, confidence=0.99, full_scan=False):
     steep_slope = 0.3
     not_flat = 0.01
     i_start = None
     v_start = None
-    i_end = None
-    v_end = None
     ss_check1 = 'N'
     ss_check2 = 'N'
     scale_max = 2
     ss_1 = 0
 
-    ## Placeholder for the starting index of sample selection
-    samp_start = None
-    ## Placeholder for the ending index of sample selection
-    samp_end = None
-    ## List of guesses for each selection, whether selection is thought to be inverted, normal, or unknown
-    inv_guesses = []
+    ## Float arrays are reduced in place, anything else is copied into one
+    if isinstance(lst, np.ndarray) and lst.dtype.kind == 'f':
+        values = lst
+    else:
+        values = np.array(lst, dtype=np.float64)
+    num_vals = len(values)
+    if num_vals < 2:
+        return lst
+
+    ## Slope into each sample, indices of the slopes each state waits on
+    slopes = np.diff(values)
+    index = np.arange(1, num_vals)
+    not_flats = index[np.abs(slopes) >= not_flat]
+    steeps = index[np.abs(slopes) >= steep_slope]
+    rises = index[slopes >= not_flat]
+    falls = index[slopes <= -not_flat]
+    flats = index[np.abs(slopes) <= not_flat]
+
+    ## Reduced segments, with the values they replaced
+    fills = []
+
+    i = 1
+    while True:
+        ## Next sample where anything can happen, nothing changes on the samples in between
+        if i_start is None:
+            i = next_index(not_flats, i, num_vals)
+        elif ss_check1 == 'N':
+            i = min(next_index(steeps, i, num_vals), i_start + 50)
+        elif ss_check2 == 'N':
+            i = min(next_index(steeps, i, num_vals), next_index(falls if ss_1 > 0 else rises, i, num_vals))
+        else:
+            i = next_index(flats, i, num_vals)
+        if i >= num_vals:
+            break
+        v = values[i]
 
-    for i, v in enumerate(lst):
         ## Start of the segment index & value taken,if unrealistic tall peaks created in flat_peak_reduct, reduce
-        if i > 0:
-            slope = v - lst[i - 1]
-            if i_start == None and abs(slope) >= not_flat:
-                i_start = i - 1
-                v_start = lst[i - 1]
-            if abs(slope) >= steep_slope:
-                ss_check1 = 'Y'
-                ss_1 = slope
-                if i_start == None:
-                    i_start = i - 1
-                    v_start = lst[i - 1]
-            if slope != 0 and ss_1 != 0 and ss_check1 == 'Y' and abs(slope) >= not_flat and int(
-                    slope / abs(slope)) == int(ss_1 / abs(ss_1) * (-1)):
-                ss_check2 = 'Y'
-
-            ## If not a steep slope, reset values for next iteration
-            if i_start != None and ss_check1 == 'N' and i - i_start >= 50:
-                i_start = None
-                v_start = None
-                i_end = None
-                v_end = None
-                ss_check1 = 'N'
-                ss_check2 = 'N'
-
-            ## If it is a steep slope, reduce segment
-            if i_start != None and ss_check2 == 'Y' and abs(slope) <= not_flat:
-                i_end = i
-                v_end = v
-                len_ss = i_end - i_start
-                vals = lst[i_start:i_end]
-                fill = []
-                v_dif = v_end - v_start
-                step = v_dif / len_ss
-                val = v_start
-                most_dif_val = max(map(lambda x: abs(x - v_start), vals))
-                if most_dif_val >= scale_max:
-                    for gap in range(len_ss):
-                        fill.append(val)
-                        val += step
-                    lst[i_start:i_end] = fill
-
-                i_start = None
-                v_start = None
-                i_end = None
-                v_end = None
-                ss_check1 = 'N'
-                ss_check2 = 'N'
-                ss_1 = 0
-
-            ##Detection of inverted signal by taking samples (1000 datapoints) of normal sections of data
-            ## After slope is not flat, index & value taken for start of the sample selection
-            if samp_start == None and slope <= not_flat:
-                samp_start = i - 1
-                ss_v = v
-
-            ## If sample selection has started and either a steep slope or tall peak is detected, restart selection
-            if samp_start != None and (slope >= steep_slope or abs(
-                    v - ss_v) > scale_max):
-                samp_start = None
-
-            ## Once clean selection of 1000 data points is found, take last index of sample selection
-            ## Create a list of values from start to end of sample
-            if samp_start != None and i - samp_start == 1000:
-                samp_end = i
-                samp_vals = lst[samp_start:samp_end]
-
-                ## Max, min, & midpoint values of sample
-                max_sv = max(samp_vals)
-                min_sv = min(samp_vals)
-                mid_sv = (max_sv + min_sv) / 2
-
-                ## Find the percentage of values within the sample that fit the top & bottom half of the range
-                top = sum(1 for x in samp_vals if mid_sv <= x <= max_sv) / len(
-                    samp_vals) * 100
-                bottom = sum(1 for x in samp_vals if min_sv <= x <= mid_sv) / len(
-                    samp_vals) * 100
-
-                ## If 75% or more of the data points are in the top half of the sample range, label guess- 'inverted'
-                ## If data points are in bottom half of the range, label guess- 'normal'
-                ## Everything else is labeled- 'unknown', then restart sample selection
-                if top >= 75:
-                    inv_guesses.append('inv')
-                elif bottom >= 75:
-                    inv_guesses.append('norm')
-                else:
-                    inv_guesses.append('unk')
-                samp_start = None
+        slope = v - values[i - 1]
+        if i_start is None and abs(slope) >= not_flat:
+            i_start = i - 1
+            v_start = values[i - 1]
+        if abs(slope) >= steep_slope:
+            ss_check1 = 'Y'
+            ss_1 = slope
+        if slope != 0 and ss_1 != 0 and ss_check1 == 'Y' and abs(slope) >= not_flat and (slope > 0) != (ss_1 > 0):
+            ss_check2 = 'Y'
+
+        ## If not a steep slope, reset values for next iteration
+        if i_start is not None and ss_check1 == 'N' and i - i_start >= 50:
+            i_start = None
+            v_start = None
+            ss_check1 = 'N'
+            ss_check2 = 'N'
+
+        ## If it is a steep slope, reduce segment
+        if i_start is not None and ss_check2 == 'Y' and abs(slope) <= not_flat:
+            len_ss = i - i_start
+            step = (v - v_start) / len_ss
+            most_dif_val = np.max(np.abs(values[i_start:i] - v_start))
+            if most_dif_val >= scale_max:
+                fills.append((i_start, i, values[i_start:i].copy()))
+                fill = np.full(len_ss, step, dtype=values.dtype)
+                fill[0] = v_start
+                values[i_start:i] = np.cumsum(fill)
+
+            i_start = None
+            v_start = None
+            ss_check1 = 'N'
+            ss_check2 = 'N'
+            ss_1 = 0
+        i += 1
+
+    ##Detection of inverted signal by taking samples (1000 datapoints) of normal sections of data
+    inverted = None
+    if inv_guesses is None and not full_scan:
+        inverted = sampled_inversion(values, fills, steep_slope, not_flat, scale_max, confidence)
+
+    ## Otherwise every clean selection is voted on, found on the values from before any reduction
+    if inverted is None:
+        original = replaced_values(values, fills, [fill[1] for fill in fills], 0, num_vals)
+        guesses = selection_guesses(values, clean_selections(original, slopes, steep_slope, not_flat, scale_max), fills)
+        if inv_guesses is not None:
+            inv_guesses.extend(guesses)
+            return values_out(lst, values)
+        inverted = inverted_vote([guess for end, guess in guesses])
+
+    ## If best guess is 'inverted' with high enough probability, call negdata_flip to invert signal
+    if inverted:
+        print(' Inverted signal detected')
+        print(' Un-inverting data')
+        negdata_flip(values, out=values)
+
+    return values_out(lst, values)
+
+
+
+## Hands reduced values back the way they came in, lists are refilled in place
+def values_out(lst, values):
+    if isinstance(lst, list):
+        lst[:] = values.tolist()
+        return lst
+
+    return values
+
+
+
+## Clean 1000 sample selections for the inversion check, as (start, end) pairs
+## After slope is not rising, a selection starts, it is dropped on a steep rise or a value
+## more than scale_max from its first value
+def clean_selections(values, slopes, steep_slope, not_flat, scale_max):
+    num_vals = len(values)
+    index = np.arange(1, num_vals)
+    not_rising = index[slopes <= not_flat]
+    steep_rises = index[slopes >= steep_slope]
+    selections = []
+
+    i = 1
+    while True:
+        i = next_index(not_rising, i, num_vals)
+        if i >= num_vals:
+            break
+        samp_start = i - 1
+        ss_v = values[i]
+        samp_end = samp_start + 1000
+
+        ## First sample after the start that drops the selection, if any before it is complete
+        rise = next_index(steep_rises, i + 1, num_vals)
+        last = min(rise, samp_end, num_vals - 1)
+        far = np.flatnonzero(np.abs(values[i + 1:last + 1] - ss_v) > scale_max)
+        if len(far) > 0:
+            i = i + 2 + int(far[0])
+        elif rise <= samp_end and rise < num_vals:
+            i = rise + 1
+        elif samp_end < num_vals:
+            selections.append((samp_start, samp_end))
+            i = samp_end + 1
+        else:
+            break
+
+    return selections
+
+
+
+## Guesses for the clean selections, whether each is thought to be inverted, normal, or unknown
+## Each selection is judged on the values as they were once it was complete, a segment reduced
+## after that is seen as it was before
+def selection_guesses(values, selections, fills, rows_at_once=4096):
+    guesses = []
+    if len(selections) == 0:
+        return guesses
+    bounds = np.array(selections)
+    ends = bounds[:, 1]
+
+    for first in range(0, len(bounds), rows_at_once):
+        part = bounds[first:first + rows_at_once]
+        samp_vals = values[part[:, 0][:, None] + np.arange(1000)]
+
+        ## Segments reduced after a selection ended but starting inside it
+        for (fs, fe, replaced) in fills:
+            lo = max(int(np.searchsorted(ends, fs, side='right')), first)
+            hi = min(int(np.searchsorted(ends, fe, side='left')), first + len(part))
+            for k in range(lo, hi):
+                (start, end) = bounds[k]
+                cut = max(fs, start)
+                samp_vals[k - first, cut - start:end - start] = replaced[cut - fs:end - fs]
+
+        ## Max, min, & midpoint values of sample
+        max_sv = samp_vals.max(axis=1)[:, None]
+        min_sv = samp_vals.min(axis=1)[:, None]
+        mid_sv = (max_sv + min_sv) / 2
+
+        ## Find the percentage of values within the sample that fit the top & bottom half of the range
+        top = np.count_nonzero((mid_sv <= samp_vals) & (samp_vals <= max_sv), axis=1) / 1000 * 100
+        bottom = np.count_nonzero((min_sv <= samp_vals) & (samp_vals <= mid_sv), axis=1) / 1000 * 100
+
+        ## If 75% or more of the data points are in the top half of the sample range, label guess- 'inverted'
+        ## If data points are in bottom half of the range, label guess- 'normal'
+        ## Everything else is labeled- 'unknown'
+        guess = np.where(top >= 75, 'inv', np.where(bottom >= 75, 'norm', 'unk'))
+        guesses.extend(zip(part[:, 1].tolist(), guess.tolist()))
+
+    return guesses
+
+
+
+## Inversion check on clean selections sampled from spans of the node taken in random order
+## One selection is looked for per span, the guesses are voted on a batch at a time until the share of 'inverted'
+## is settled above or below 60% at the given confidence (Wilson score interval, narrowed by the share of
+## spans already used)
+## Returns True if the node is thought to be inverted, None if the vote never settled
+def sampled_inversion(values, fills, steep_slope, not_flat, scale_max, confidence=0.99, span=4000, batch=16, seed=0):
+    from statistics import NormalDist
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    spans = np.random.default_rng(seed).permutation(np.arange(0, len(values), span))
+    fill_ends = [fill[1] for fill in fills]
+    guesses = []
+
+    for first in range(0, len(spans), batch):
+        ## First clean selection in each span, found on the values from before any reduction
+        selections = []
+        for start in spans[first:first + batch]:
+            section = replaced_values(values, fills, fill_ends, start, start + span)
+            found = clean_selections(section, np.diff(section), steep_slope, not_flat, scale_max)
+            if len(found) > 0:
+                selections.append((start + found[0][0], start + found[0][1]))
+        selections.sort()
+        guesses.extend(guess for end, guess in selection_guesses(values, selections, fills))
+
+        ## Settled once the interval for the share of 'inverted' guesses is all on one side of 60%
+        num_guesses = len(guesses)
+        used = min(first + batch, len(spans))
+        if num_guesses > 0 and used < len(spans):
+            share = guesses.count('inv') / num_guesses
+            center = (share + z * z / (2 * num_guesses)) / (1 + z * z / num_guesses)
+            margin = z / (1 + z * z / num_guesses) * np.sqrt(
+                share * (1 - share) / num_guesses + z * z / (4 * num_guesses * num_guesses))
+            margin *= np.sqrt((len(spans) - used) / (len(spans) - 1))
+            if center - margin > 0.6:
+                return True
+            if center + margin <= 0.6:
+                return False
+
+    return None
+
+
+
+## Values from start to stop as they were before any segment was reduced
+## fill_ends are the (sorted) ends of the reduced segments
+def replaced_values(values, fills, fill_ends, start, stop):
+    from bisect import bisect_right
+
+    section = values[start:stop].copy()
+    for (fs, fe, replaced) in fills[bisect_right(fill_ends, start):]:
+        if fs >= stop:
+            break
+        lo = max(fs, start)
+        hi = min(fe, stop)
+        section[lo - start:hi - start] = replaced[lo - fs:hi - fs]
+
+    return section
+
 
-    ## For the list of guesses, find highest occurrence & probability
+
+## For the list of guesses, find highest occurrence & probability
+## Inverted if the best guess is 'inverted' and probability is higher than 60%
+def inverted_vote(inv_guesses):
     if len(inv_guesses) > 0:
         guess = max(inv_guesses, key=inv_guesses.count)
         guess_perc = round(inv_guesses.count(guess) / len(inv_guesses) * 100, 2)
-
-        ## If best guess is 'inverted' and probability is higher than 60%, call negdata_flip to invert signal
         if guess == 'inv' and guess_perc > 60:
-            print(' Inverted signal detected')
-            print(' Un-inverting data')
-            lst[:] = negdata_flip(lst)
+            return True
 
-    return lst
+    return False
 
   
 
 ## Inverts any raw negative mV peaks data to positive, normal ECG
-def negdata_flip(data_section):
+## out may be data_section itself to flip in place
+def negdata_flip(data_section, out=None):
     ## HeartPy Defaults: enhance_peaks = F, keep_range = T
     enhance_peaks = False
     keep_range = True
-    out_array = flip_signal(data_section, enhance_peaks, keep_range)
+    out_array = flip_signal(data_section, enhance_peaks, keep_range, out=out)
 
     return out_array
 
 
   
 ## Provides user option to save or print processed data locally
-def print_dict(dictionary, outfile):
+## Rows are written one window at a time so a mapped data set is never read in whole
+def print_dict(dictionary, outfile, window=1000000):
     ## Write the header
     header = []
     for key in dictionary:
         header.append(key)
     outfile.write(", ".join(header) + '\n')
 
-    ## Write data set values
-    print_line = []
-    for key, items in dictionary.items():
-        for i in range(len(dictionary[key])):
-            for k in range(len(dictionary)):
-                print_line.append(str(dictionary[list(dictionary)[k]][i]))
-            outfile.write(", ".join(print_line) + '\n')
-            print_line.clear()
+    ## Write data set values, one line per sample with the local timestamp first
+    for start in range(0, len(dictionary['Time']), window):
+        stop = start + window
+        times = np.char.replace(np.datetime_as_string(dictionary.local_time(start, stop), unit='us'), 'T', ' ')
+        if dictionary.tz is not None:
+            times = np.char.add(times, tz_suffix(dictionary.tz))
+        columns = [times] + [dictionary.grid(key, start, stop) for key in dictionary.nodes]
+        for row in zip(*columns):
+            outfile.write(", ".join(map(str, row)) + '\n')
+
+
+
+## Timezone as printed after a timestamp, such as -05:00
+def tz_suffix(tz):
+    offset = int(tz.utcoffset(None).total_seconds()) // 60
+    sign = '-' if offset < 0 else '+'
+
+    return '%s%02d:%02d' % (sign, abs(offset) // 60, abs(offset) % 60)
 
 
             
@@ -695,23 +3096,12 @@ if __name__ == '__main__':
     ## Ask user for data set or file name
     dataset = input('HRVY Begin\nEnter the name of the data set or the file name: ')
 
-    ## Call file opener
-    contents = file_opener(dataset)
-
-    if contents != 'end':
-        ## If file present, then unpack tuple
-        (hdr, csv) = contents
-
-        ## Call hdr_data- dictionary builder & node info
-        hdr_info = hdr_data(hdr)
-        (hdr_dat, nodes_not_2ms) = hdr_info
-
-        ## Call dat_file generation
-        dat_align = align_plus_dat(hdr_dat, csv)
-        (align_cont, file_dat) = dat_align
+    ## Open through the cache, the data set is only parsed the first time it is seen
+    ## Non-2ms nodes are filled in on the 2ms grid as before, see open_dataset for native
+    final_dat = open_dataset(dataset)
 
-        ## Call alignment checker & outfile writer
-        final_dat = time_out(csv, file_dat, nodes_not_2ms, align_cont)
+    if final_dat != 'end':
+        print(' >', len(final_dat.gaps), 'time gaps filled,', final_dat.gaps['samples'].sum(), 'baseline samples added')
 
         ## Call printing options
         plot_out(final_dat, dataset)
@@ -0,0 +1,52 @@
+## Shared helpers for the hrvy tests, the module under test lives one folder up
+import datetime as dt
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HDR = ['{id: 15, label: aVR, unit: mV, period: 2ms}\n',
+       '{id: 43, label: V, unit: mV, period: 2ms}\n',
+       '{id: 61, label: V, unit: mV, period: 4ms}\n',
+       '{id: 62, label: II, unit: mV, period: 8ms}\n']
+
+
+
+## Writes <path>.hdr & <path>.csv like the monitor exports them
+## gaps maps a row to the number of extra 2ms steps before it (negative jumps back), every row is stamped
+## once in stamp_every rows & on every gap, blanks & 0.5 values are mixed in, non-2ms nodes are only
+## recorded on their own period
+def write_dataset(path, num_rows=6000, seed=0, hdr=HDR, gaps=None, stamp_every=1, dropouts=None):
+    rng = np.random.default_rng(seed)
+    gaps = {2000: 7, 4000: 300, 5000: -3} if gaps is None else gaps
+    dropouts = {} if dropouts is None else dropouts
+    periods = [int(line.split('period: ')[1].split('ms')[0]) for line in hdr]
+    when = dt.datetime(2021, 2, 10, 12, 0, 0, tzinfo=dt.timezone(dt.timedelta(hours=-5)))
+    step = 0
+    lines = []
+    for row in range(num_rows):
+        stamp = row % stamp_every == 0
+        if row in gaps:
+            when += dt.timedelta(milliseconds=2 * gaps[row])
+            step += gaps[row]
+            stamp = True
+        step += dropouts.get(row, 0)
+        values = []
+        for col, period in enumerate(periods):
+            if step % (period // 2) != 0 or rng.random() < 0.01:
+                values.append('')
+            else:
+                value = round(float(np.sin(row / 40.0 + col) + rng.normal(0, 0.05)), 3)
+                values.append('0.5' if rng.random() < 0.02 else str(value))
+        stamp_text = when.strftime('%Y-%m-%d %H:%M:%S.') + when.strftime('%f')[:3] + ' -0500'
+        lines.append((stamp_text if stamp else '') + ', ' + ', '.join(values) + '\n')
+        when += dt.timedelta(milliseconds=2)
+        step += 1
+    with open(path + '.hdr', 'w') as f:
+        f.writelines(hdr)
+    with open(path + '.csv', 'w') as f:
+        f.writelines(lines)
+
+    return (list(hdr), lines)
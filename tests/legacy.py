@@ -0,0 +1,393 @@
+## Loop versions of the hrvy stages as they were before they were vectorized, copied unchanged
+## Kept only as oracles, the tests fuzz the new code against them
+import numpy as np
+
+
+
+def scale_data(data, lower=0, upper=1024):
+    rng = np.max(data) - np.min(data)
+    minimum = np.min(data)
+    data = (upper - lower) * ((data - minimum) / rng) + lower
+    return data
+
+
+def enhance_peaks(hrdata, iterations=2):
+    scale_data(hrdata)
+    for i in range(iterations):
+        hrdata = np.power(hrdata, 2)
+        hrdata = scale_data(hrdata)
+    return hrdata
+
+
+def flip_signal(data, enhancepeaks=False, keep_range=True):
+    data_mean = np.mean(data)
+    data_min = np.min(data)
+    data_max = np.max(data)
+
+    # invert signal
+    data = (data_mean - data) + data_mean
+
+    if keep_range:
+        # scale data so original range is maintained
+        data = scale_data(data, lower=data_min, upper=data_max)
+    if enhancepeaks:
+        data = enhance_peaks(data)
+    return data
+
+
+
+def hdr_data(hdr):
+    hdr_dat = {}
+    node = 1
+    nodes_not_2ms = {}
+
+    ## Node information is formatted
+    for line in hdr:
+        l_split = line.strip('{').strip('\n').strip('}').split(', ')
+
+        ## Creates new nested dictionary with each line read in .hdr file
+        hdr_dat[node] = {}
+        for item in l_split:
+            hdr_dat[node][item.split()[0].strip(':')] = item.split()[1]
+            if item.split()[0].strip(':') == 'period' and item.split()[1] != '2ms':
+                nodes_not_2ms[int(item.split()[1].strip('ms'))] = node
+        node += 1
+
+    ## Packed into tuple and returned
+    hdr_info = (hdr_dat, nodes_not_2ms)
+
+    return hdr_info
+
+
+
+## Determines if csv is pre-aligned
+def align_plus_dat(hdr_dat, csv):
+    aligned = ''
+
+    ## Number of lines in .hdr file
+    num_nodes = len(hdr_dat)
+
+    ## Number of columns at the beginning of .csv file
+    num_cols_start = len((csv[0]).split(','))
+
+    ## Missing number of columns at the beginning of .csv file
+    num_cols_mis = num_nodes + 1 - num_cols_start
+
+    ## If no columns are missing
+    if num_cols_mis == 0:
+        print('No missing columns found, csv file pre-aligned')
+        aligned = 'yes'
+    else:
+        print('Missing columns found, csv file not pre-aligned')
+        aligned = 'no'
+
+    ## Create new dictionary with the time for keys
+    file_dat = {}
+    file_dat['Time'] = []
+    for key in hdr_dat:
+        if hdr_dat[key]['label'] in file_dat:
+            file_dat[hdr_dat[key]['label'] + '(2)'] = []
+        else:
+            file_dat[hdr_dat[key]['label']] = []
+    hdr_dat.clear()
+
+    ## Pack into tuples & return
+    align_contents = (num_nodes, num_cols_start, num_cols_mis, aligned)
+    dat_plus_align = (align_contents, file_dat)
+
+    return dat_plus_align
+
+
+
+## Checks for time gaps & fills is missing
+def time_out(csv, file_dat, nodes_not_2ms, align_cont):
+    import datetime as dt
+
+    ## Unpack tuple from align_plus_dat
+    (num_nodes, num_cols_start, num_cols_mis, aligned) = align_cont
+
+    ## Set time object
+    last_line_time = ''
+    two_ms = dt.timedelta(milliseconds=2)
+
+    for line in csv:
+        ## If there is a timestamp, current time is kept as provided
+        if not line.startswith(','):
+            curr_line_time = dt.datetime.strptime(line.split(', ')[0], '%Y-%m-%d %H:%M:%S.%f %z')
+
+            ## Checks for time gap
+            if last_line_time != '' and curr_line_time != last_line_time + two_ms:
+                time_dif = (curr_line_time - last_line_time).total_seconds()
+                if time_dif < 180:
+                    print(' >', time_dif, 'second gap starting at', last_line_time)
+
+                ## If time gap is over a minute long
+                else:
+                    print(' >', round(time_dif / 60, 3), 'minute gap starting at', last_line_time)
+                while curr_line_time != file_dat['Time'][-1] + two_ms:
+                    file_dat['Time'].append(file_dat['Time'][-1] + two_ms)
+                    for key, items in file_dat.items():
+                        if key != 'Time':
+                            items.append(0.5)
+                    if curr_line_time - two_ms <= file_dat['Time'][-1]:
+                        break
+                print(' Gap filled')
+            ## Saves current time for reference on next line
+            last_line_time = curr_line_time
+
+        ## If timestamp not already given adds 2ms to saved reference time
+        else:
+            last_line_time += two_ms
+        file_dat['Time'].append(last_line_time)
+
+        ## Records values from csv and fills in blank columns/values with recorded values
+        ## Fills in blanks with recorded values or 0.5 (baseline) where data was not recorded
+        for n in range(1, num_cols_start):
+            file_dat[list(file_dat)[n]].append(float(line.split(', ')[n].strip() or 0.5))
+
+        ## If empty columns exist blanks are filled with 0.5 where columns are empty
+        if aligned == 'no':
+            for n in range(num_cols_mis):
+                if len(line.split(', ')) < num_nodes + 1:
+                    file_dat[list(file_dat)[num_cols_start + n]].append(
+                        0.5)
+                ## Fills in blanks with recorded values or 0.5 where data was not recorded
+                else:
+                    file_dat[list(file_dat)[num_cols_start + n]].append(float((line.split(', ')[
+                                                                                   num_cols_start + n].strip() or 0.5)))
+        ## If there are any non-2ms nodes, derive values for 2ms interval
+        if len(nodes_not_2ms) > 0:
+            for interval, node in nodes_not_2ms.items():
+                node_list = file_dat[list(file_dat)[node]]
+                min_start = (interval // 2) + 1
+                empty_vals = node_list[-(interval // 2):-1]
+                if len(node_list) > min_start and set(empty_vals) == {0.5} and node_list[-1] != 0.5:
+                    mis_val_int = (node_list[-min_start] - node_list[-1]) / (len(empty_vals) + 1)
+                    mult = 1
+                    for n in range(len(empty_vals)):
+                        node_list[-2 - n] = node_list[-1] + (mult * mis_val_int)
+                        mult += 1
+
+    print('Done pulling data')
+    return file_dat
+
+
+
+## Reduces long flat peaks
+def flat_peak_reduct(lst):
+    rep_val = None
+
+    steep_slope = 0.5
+    not_flat = 0.05
+    i_start = None
+    v_start = None
+    i_end = None
+    v_end = None
+    ss_check1 = 'N'
+    ss_check2 = 'N'
+    scale_max = 3
+    ss_1 = 0
+
+    for i, v in enumerate(lst):
+
+        ## If segement of repeated values over 20ms is found, reduce to baseline 0.5
+        if i > 0 and rep_val is None and v != 0.5 and v == lst[i - 1]:
+            rep_val = v
+            rv_start = i - 1
+        if rep_val is not None and v != rep_val:
+            rv_end = i
+            len_rep_val = rv_end - rv_start
+            if len_rep_val >= 10 and ss_check1 == 'N':
+                lst[rv_start:rv_end] = [0.5] * len_rep_val
+            rep_val = None
+
+        ## If unrealistic tall peaks or steep slopes found, reduce
+        if i > 0:
+            slope = v - lst[i - 1]
+            if i_start == None and abs(slope) >= not_flat:
+                i_start = i - 1
+                v_start = lst[i - 1]
+            if abs(slope) >= steep_slope:
+                ss_check1 = 'Y'
+                ss_1 = slope
+                if i_start == None:
+                    i_start = i - 1
+                    v_start = lst[i - 1]
+            if slope != 0 and ss_1 != 0 and ss_check1 == 'Y' and abs(slope) >= not_flat and int(
+                    slope / abs(slope)) == int(ss_1 / abs(ss_1) * (-1)):
+                ss_check2 = 'Y'
+
+            ## If not a steep slope, reset values for next iteration
+            if i_start != None and ss_check1 == 'N' and i - i_start >= 50:
+                i_start = None
+                v_start = None
+                i_end = None
+                v_end = None
+                ss_check1 = 'N'
+                ss_check2 = 'N'
+
+            ## If it is a steep slope, reduce segment
+            if i_start != None and ss_check2 == 'Y' and slope != 0 and abs(slope) <= not_flat and rep_val == None:
+                if i_start == 0:
+                    v_start = v
+                i_end = i
+                v_end = v
+                len_ss = i_end - i_start
+                fill = []
+                v_dif = v_end - v_start
+                step = v_dif / len_ss
+                val = v_start
+                vals = lst[i_start:i_end]
+                most_dif_val = max(map(lambda x: abs(x - v_start), vals))
+                if most_dif_val >= scale_max:
+                    for gap in range(len_ss):
+                        fill.append(val)
+                        val += step
+                    lst[i_start:i_end] = fill
+
+                ## Clears values for next iteration
+                i_start = None
+                v_start = None
+                i_end = None
+                v_end = None
+                ss_check1 = 'N'
+                ss_check2 = 'N'
+                ss_1 = 0
+
+    return lst
+
+
+
+## Removes unrealistic point and checks for data inversion
+def tall_peak_reduct(lst):
+    steep_slope = 0.3
+    not_flat = 0.01
+    i_start = None
+    v_start = None
+    i_end = None
+    v_end = None
+    ss_check1 = 'N'
+    ss_check2 = 'N'
+    scale_max = 2
+    ss_1 = 0
+
+    ## Placeholder for the starting index of sample selection
+    samp_start = None
+    ## Placeholder for the ending index of sample selection
+    samp_end = None
+    ## List of guesses for each selection, whether selection is thought to be inverted, normal, or unknown
+    inv_guesses = []
+
+    for i, v in enumerate(lst):
+        ## Start of the segment index & value taken,if unrealistic tall peaks created in flat_peak_reduct, reduce
+        if i > 0:
+            slope = v - lst[i - 1]
+            if i_start == None and abs(slope) >= not_flat:
+                i_start = i - 1
+                v_start = lst[i - 1]
+            if abs(slope) >= steep_slope:
+                ss_check1 = 'Y'
+                ss_1 = slope
+                if i_start == None:
+                    i_start = i - 1
+                    v_start = lst[i - 1]
+            if slope != 0 and ss_1 != 0 and ss_check1 == 'Y' and abs(slope) >= not_flat and int(
+                    slope / abs(slope)) == int(ss_1 / abs(ss_1) * (-1)):
+                ss_check2 = 'Y'
+
+            ## If not a steep slope, reset values for next iteration
+            if i_start != None and ss_check1 == 'N' and i - i_start >= 50:
+                i_start = None
+                v_start = None
+                i_end = None
+                v_end = None
+                ss_check1 = 'N'
+                ss_check2 = 'N'
+
+            ## If it is a steep slope, reduce segment
+            if i_start != None and ss_check2 == 'Y' and abs(slope) <= not_flat:
+                i_end = i
+                v_end = v
+                len_ss = i_end - i_start
+                vals = lst[i_start:i_end]
+                fill = []
+                v_dif = v_end - v_start
+                step = v_dif / len_ss
+                val = v_start
+                most_dif_val = max(map(lambda x: abs(x - v_start), vals))
+                if most_dif_val >= scale_max:
+                    for gap in range(len_ss):
+                        fill.append(val)
+                        val += step
+                    lst[i_start:i_end] = fill
+
+                i_start = None
+                v_start = None
+                i_end = None
+                v_end = None
+                ss_check1 = 'N'
+                ss_check2 = 'N'
+                ss_1 = 0
+
+            ##Detection of inverted signal by taking samples (1000 datapoints) of normal sections of data
+            ## After slope is not flat, index & value taken for start of the sample selection
+            if samp_start == None and slope <= not_flat:
+                samp_start = i - 1
+                ss_v = v
+
+            ## If sample selection has started and either a steep slope or tall peak is detected, restart selection
+            if samp_start != None and (slope >= steep_slope or abs(
+                    v - ss_v) > scale_max):
+                samp_start = None
+
+            ## Once clean selection of 1000 data points is found, take last index of sample selection
+            ## Create a list of values from start to end of sample
+            if samp_start != None and i - samp_start == 1000:
+                samp_end = i
+                samp_vals = lst[samp_start:samp_end]
+
+                ## Max, min, & midpoint values of sample
+                max_sv = max(samp_vals)
+                min_sv = min(samp_vals)
+                mid_sv = (max_sv + min_sv) / 2
+
+                ## Find the percentage of values within the sample that fit the top & bottom half of the range
+                top = sum(1 for x in samp_vals if mid_sv <= x <= max_sv) / len(
+                    samp_vals) * 100
+                bottom = sum(1 for x in samp_vals if min_sv <= x <= mid_sv) / len(
+                    samp_vals) * 100
+
+                ## If 75% or more of the data points are in the top half of the sample range, label guess- 'inverted'
+                ## If data points are in bottom half of the range, label guess- 'normal'
+                ## Everything else is labeled- 'unknown', then restart sample selection
+                if top >= 75:
+                    inv_guesses.append('inv')
+                elif bottom >= 75:
+                    inv_guesses.append('norm')
+                else:
+                    inv_guesses.append('unk')
+                samp_start = None
+
+    ## For the list of guesses, find highest occurrence & probability
+    if len(inv_guesses) > 0:
+        guess = max(inv_guesses, key=inv_guesses.count)
+        guess_perc = round(inv_guesses.count(guess) / len(inv_guesses) * 100, 2)
+
+        ## If best guess is 'inverted' and probability is higher than 60%, call negdata_flip to invert signal
+        if guess == 'inv' and guess_perc > 60:
+            print(' Inverted signal detected')
+            print(' Un-inverting data')
+            lst[:] = negdata_flip(lst)
+
+    return lst
+
+
+
+## Inverts any raw negative mV peaks data to positive, normal ECG
+def negdata_flip(data_section):
+    ## HeartPy Defaults: enhance_peaks = F, keep_range = T
+    enhance_peaks = False
+    keep_range = True
+    out_array = flip_signal(data_section, enhance_peaks, keep_range)
+
+    return out_array
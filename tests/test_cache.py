@@ -0,0 +1,245 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+import hrvy_v1 as hrvy
+from conftest import write_dataset
+
+
+
+## Opens a data set & returns it with everything it printed
+def open_quietly(path, **kwargs):
+    printed = io.StringIO()
+    with contextlib.redirect_stdout(printed):
+        rec = hrvy.open_dataset(path, **kwargs)
+    return (rec, printed.getvalue())
+
+
+
+## A cat file (hdr lines at the top) that was only touched is recognised by its content hash, not rebuilt
+def test_touched_cat_file_keeps_its_cache(tmp_path):
+    path = os.path.join(tmp_path, 'cat')
+    (hdr, csv) = write_dataset(path)
+    with open(path + '.cat', 'w') as f:
+        f.writelines(hdr + csv)
+    os.remove(path + '.csv')
+    os.remove(path + '.hdr')
+
+    (built, printed) = open_quietly(path)
+    assert 'Data set cached' in printed
+    stat = os.stat(path + '.cat')
+    os.utime(path + '.cat', ns=(stat.st_atime_ns, stat.st_mtime_ns + 5000000000))
+    (loaded, printed) = open_quietly(path)
+    assert 'Data set changed' not in printed and 'Data set cached' not in printed
+    assert 'Cached data set loaded' in printed
+    for key in built:
+        assert np.array_equal(loaded[key], built[key])
+
+
+
+## A float32 cache grown row by row holds the same values as one built in one go, held back samples
+## are only rounded to float32 once
+@pytest.mark.parametrize('split', [1000, 1047, 1217])
+def test_float32_append_matches_fresh_cache(tmp_path, split):
+    (hdr, csv) = write_dataset(os.path.join(tmp_path, 'fresh'))
+    (fresh, printed) = open_quietly(os.path.join(tmp_path, 'fresh'), dtype=np.float32)
+
+    path = os.path.join(tmp_path, 'grow')
+    write_dataset(path)
+    with open(path + '.csv', 'w') as f:
+        f.writelines(csv[:split])
+    open_quietly(path, dtype=np.float32)
+    with open(path + '.csv', 'a') as f:
+        f.writelines(csv[split:])
+    (grown, printed) = open_quietly(path, dtype=np.float32)
+    assert 'New rows added' in printed
+    for key in fresh:
+        assert np.array_equal(grown[key], fresh[key]), key
+
+
+
+## Rows added to a csv whose hdr file was only touched are appended, the hdr is checked by its hash
+def test_append_with_touched_hdr(tmp_path):
+    path = os.path.join(tmp_path, 'grow')
+    (hdr, csv) = write_dataset(path)
+    (fresh, printed) = open_quietly(path)
+    with open(path + '.csv', 'w') as f:
+        f.writelines(csv[:3000])
+    open_quietly(path)
+    stat = os.stat(path + '.hdr')
+    os.utime(path + '.hdr', ns=(stat.st_atime_ns, stat.st_mtime_ns + 5000000000))
+    with open(path + '.csv', 'a') as f:
+        f.writelines(csv[3000:])
+    (grown, printed) = open_quietly(path)
+    assert 'New rows added' in printed
+    for key in fresh:
+        assert np.array_equal(grown[key], fresh[key]), key
+
+
+
+## An empty cat file is reported as not concatenated rather than failing to map
+def test_cat_file_mmap_empty(tmp_path):
+    path = os.path.join(tmp_path, 'empty.cat')
+    open(path, 'w').close()
+    printed = io.StringIO()
+    with contextlib.redirect_stdout(printed):
+        assert hrvy.cat_file_mmap(path) == 'end'
+    assert 'not a concatenated file' in printed.getvalue()
+
+
+
+## file_opener maps a cat file, the buffer of rows it hands back is aligned & parsed like the list of lines
+def test_file_opener_maps_cat_file(tmp_path, monkeypatch):
+    (hdr, csv) = write_dataset(os.path.join(tmp_path, 'cat'), 3000)
+    csv = [', '.join(line.split(', ')[:-2]) + '\n' if row % 3 == 0 else line for row, line in enumerate(csv)]
+    with open(os.path.join(tmp_path, 'cat.cat'), 'w') as f:
+        f.writelines(hdr + csv)
+    monkeypatch.chdir(tmp_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        (cat_hdr, rows) = hrvy.file_opener('cat')
+    assert isinstance(rows, memoryview) and cat_hdr == hdr
+    mapped = parse_lines(cat_hdr, rows)
+    expected = parse_lines(hdr, csv)
+    for key in expected:
+        assert np.array_equal(mapped[key], expected[key]), key
+
+
+
+## Opening a cache leaves meta.json alone unless a touched source had its mtime refreshed
+def test_meta_written_only_on_refresh(tmp_path):
+    path = os.path.join(tmp_path, 'meta')
+    write_dataset(path)
+    open_quietly(path)
+    meta_file = os.path.join(path + '.csv.hrvy', 'meta.json')
+    os.utime(meta_file, ns=(0, 0))
+    open_quietly(path)
+    assert os.stat(meta_file).st_mtime_ns == 0
+
+    stat = os.stat(path + '.csv')
+    os.utime(path + '.csv', ns=(stat.st_atime_ns, stat.st_mtime_ns + 5000000000))
+    (loaded, printed) = open_quietly(path)
+    assert 'Cached data set loaded' in printed
+    assert os.stat(meta_file).st_mtime_ns != 0
+    assert not os.path.exists(meta_file + '.tmp')
+    os.utime(meta_file, ns=(0, 0))
+    open_quietly(path)
+    assert os.stat(meta_file).st_mtime_ns == 0
+
+
+
+## A touched data file is hashed once per open, not again when the cache is mapped in
+def test_touched_file_hashed_once(tmp_path, monkeypatch):
+    path = os.path.join(tmp_path, 'once')
+    write_dataset(path)
+    open_quietly(path)
+    stat = os.stat(path + '.csv')
+    os.utime(path + '.csv', ns=(stat.st_atime_ns, stat.st_mtime_ns + 5000000000))
+    hashed = []
+    file_sha1 = hrvy.file_sha1
+    monkeypatch.setattr(hrvy, 'file_sha1', lambda *args: hashed.append(args[0]) or file_sha1(*args))
+    (loaded, printed) = open_quietly(path)
+    assert 'Cached data set loaded' in printed
+    assert hashed == [path + '.csv']
+
+
+
+## Parses a data set in memory, the reference the cache has to match
+def parse_lines(hdr, csv, native=False):
+    with contextlib.redirect_stdout(io.StringIO()):
+        (hdr_dat, nodes_not_2ms) = hrvy.hdr_data(hdr)
+        (align_cont, file_dat) = hrvy.align_plus_dat(hdr_dat, csv)
+        return hrvy.time_out_np(csv, file_dat, nodes_not_2ms, align_cont, native)
+
+
+## An export whose last row has no newline is cached with that row & loaded from the cache after
+def test_last_row_without_newline(tmp_path):
+    path = os.path.join(tmp_path, 'nonl')
+    (hdr, csv) = write_dataset(path, 3000)
+    csv[-1] = csv[-1].rstrip('\n')
+    with open(path + '.csv', 'w') as f:
+        f.writelines(csv)
+    expected = parse_lines(hdr, csv)
+    (built, printed) = open_quietly(path)
+    (loaded, printed) = open_quietly(path)
+    assert 'Cached data set loaded' in printed and 'cached\n' not in printed
+    stat = os.stat(path + '.csv')
+    os.utime(path + '.csv', ns=(stat.st_atime_ns, stat.st_mtime_ns + 5000000000))
+    (touched, printed) = open_quietly(path)
+    assert 'Cached data set loaded' in printed
+    for rec in (built, loaded, touched):
+        for key in expected:
+            assert np.array_equal(rec[key], expected[key]), key
+
+
+
+## A row caught half written is parsed as it stands, then redone once the rest of the file is there
+@pytest.mark.parametrize('native', [False, True])
+@pytest.mark.parametrize('row', [3001, 4000])
+def test_half_written_row_is_redone(tmp_path, native, row):
+    path = os.path.join(tmp_path, 'half')
+    (hdr, csv) = write_dataset(path, dropouts={4000: 1})
+    text = ''.join(csv)
+    cut = len(''.join(csv[:row])) + csv[row].index(', ') + 4
+    with open(path + '.csv', 'w') as f:
+        f.write(text[:cut])
+    (part, printed) = open_quietly(path, native=native)
+    expected = parse_lines(hdr, text[:cut].splitlines(keepends=True), native)
+    for key in expected:
+        assert np.array_equal(part.grid(key) if key != 'Time' else part[key],
+                              expected.grid(key) if key != 'Time' else expected[key]), key
+
+    with open(path + '.csv', 'a') as f:
+        f.write(text[cut:])
+    (grown, printed) = open_quietly(path, native=native)
+    assert 'New rows added' in printed
+    expected = parse_lines(hdr, csv, native)
+    assert np.array_equal(grown.gaps, expected.gaps)
+    for key in expected:
+        assert np.array_equal(grown.grid(key) if key != 'Time' else grown[key],
+                              expected.grid(key) if key != 'Time' else expected[key]), key
+
+
+
+## Building a cache hashes the data file on the way through the ingest, only the hdr file is read again
+def test_build_hashes_only_the_hdr(tmp_path, monkeypatch):
+    path = os.path.join(tmp_path, 'build')
+    write_dataset(path)
+    hashed = []
+    file_sha1 = hrvy.file_sha1
+    monkeypatch.setattr(hrvy, 'file_sha1', lambda *args: hashed.append(args[0]) or file_sha1(*args))
+    (built, printed) = open_quietly(path)
+    assert 'Data set cached' in printed
+    assert hashed == [path + '.hdr']
+
+
+
+## A data set opened by a relative path is still corrected into its own cache folder after a chdir
+def test_store_survives_chdir(tmp_path, monkeypatch):
+    write_dataset(os.path.join(tmp_path, 'rel'))
+    monkeypatch.chdir(tmp_path)
+    (rec, printed) = open_quietly('rel')
+    os.makedirs('plots')
+    monkeypatch.chdir('plots')
+    with contextlib.redirect_stdout(io.StringIO()):
+        corrected = hrvy.corrected_dict(rec)
+    assert corrected.store == os.path.join(str(tmp_path), 'rel.csv.hrvy', 'corrected')
+    assert os.path.isfile(os.path.join(corrected.store, 'node0.bin'))
+    assert not os.path.exists(os.path.join(str(tmp_path), 'plots', 'rel.csv.hrvy'))
+
+
+
+## Asking for the other layout of the non-2ms nodes rebuilds the cache instead of loading the old one
+def test_native_change_rebuilds(tmp_path):
+    path = os.path.join(tmp_path, 'native')
+    (hdr, csv) = write_dataset(path)
+    for native in (False, True, True, False):
+        (rec, printed) = open_quietly(path, native=native)
+        expected = parse_lines(hdr, csv, native)
+        for key in expected:
+            assert isinstance(rec[key], hrvy.Channel) == isinstance(expected[key], hrvy.Channel), key
+            assert np.array_equal(rec.grid(key) if key != 'Time' else rec[key],
+                                  expected.grid(key) if key != 'Time' else expected[key]), key
+    assert 'native non-2ms nodes' in printed and 'Data set cached' in printed
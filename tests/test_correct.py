@@ -0,0 +1,69 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+
+import hrvy_v1 as hrvy
+
+
+
+## Corrects a Recording without the per node progress lines
+def correct_quietly(rec, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return hrvy.corrected_dict(rec, **kwargs)
+
+
+
+## A Recording without any nodes comes back as one, the filters never see an empty stack
+def test_no_nodes():
+    rec = hrvy.Recording(np.arange(1000, dtype=np.int64) * 2000000, {})
+    corrected = correct_quietly(rec)
+    assert corrected.nodes == {}
+    assert corrected.time is rec.time
+
+
+
+## Nodes corrected together as rows come out the same as each node corrected on its own
+def test_rows_match_single_nodes():
+    rng = np.random.default_rng(3)
+    nodes = {key: 0.5 + np.cumsum(rng.normal(0, 0.02, 20000)) for key in ['A', 'B', 'C']}
+    rec = hrvy.Recording(np.arange(20000, dtype=np.int64) * 2000000, nodes)
+    corrected = correct_quietly(rec)
+    for key in nodes:
+        single = hrvy.correct_node(nodes[key], round(rec.sample_rate, 3))
+        assert single.shape == nodes[key].shape
+        np.testing.assert_array_equal(corrected[key], single)
+
+
+
+## Nodes spread over a process pool come out exactly as corrected together in one stack
+def test_parallel_matches_serial():
+    rng = np.random.default_rng(5)
+    nodes = {key: 0.5 + np.cumsum(rng.normal(0, 0.02, 20000)) for key in ['A', 'B', 'C', 'D']}
+    rec = hrvy.Recording(np.arange(20000, dtype=np.int64) * 2000000, nodes)
+    serial = correct_quietly(rec)
+    parallel = correct_quietly(rec, workers=2)
+    for key in nodes:
+        np.testing.assert_array_equal(parallel[key], serial[key])
+
+
+
+## A Recording mapped from the cache is corrected window by window & follows the in-memory correction
+def test_store_matches_memory(tmp_path):
+    rng = np.random.default_rng(4)
+    num_rows = 60000
+    time = 1613000000000000000 + np.arange(num_rows, dtype=np.int64) * 2000000
+    nodes = {'A': 0.5 + np.cumsum(rng.normal(0, 0.02, num_rows)), 'B': 1 - np.abs(np.sin(np.arange(num_rows) / 30.)) ** 20}
+    time.tofile(os.path.join(tmp_path, 'Time.bin'))
+    mapped = {}
+    for n, key in enumerate(nodes):
+        nodes[key].tofile(os.path.join(tmp_path, 'node' + str(n) + '.bin'))
+        mapped[key] = hrvy.map_column(os.path.join(tmp_path, 'node' + str(n) + '.bin'), np.float64)
+    store = hrvy.Recording(hrvy.map_column(os.path.join(tmp_path, 'Time.bin'), np.int64), mapped)
+    store.store = str(tmp_path)
+
+    expected = correct_quietly(hrvy.Recording(time, nodes))
+    corrected = correct_quietly(store, window=7000, overlap=500)
+    for key in nodes:
+        np.testing.assert_allclose(corrected[key], expected[key], rtol=0, atol=1e-7)
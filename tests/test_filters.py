@@ -0,0 +1,44 @@
+import numpy as np
+
+import hrvy_v1 as hrvy
+
+
+
+## Both coefficient caches are reported, b & a for filtfilt & the sections the block filters use
+def test_filter_cache_info():
+    hrvy.design_filter.cache_clear()
+    hrvy.design_sos.cache_clear()
+    data = np.cumsum(np.random.default_rng(0).normal(0, 0.01, 5000))
+    for n in range(3):
+        hrvy.filter_signal(data, 0.7, 500.0, filtertype='highpass')
+        hrvy.filter_signal(data, 0.7, 500.0, filtertype='highpass', block=1000)
+    info = hrvy.filter_cache_info()
+    assert (info['design_filter'].misses, info['design_filter'].hits) == (1, 2)
+    assert (info['design_sos'].misses, info['design_sos'].hits) == (1, 2)
+
+
+
+## The batch quotient filter gives every list the mask quotient_filter gives it on its own
+def test_quotient_filter_batch():
+    rng = np.random.default_rng(1)
+    RR_lists = [rng.normal(800, 120, int(n)) for n in rng.integers(0, 40, 30)] + [[], [700.0]]
+    masks = hrvy.quotient_filter_batch(RR_lists)
+    assert len(masks) == len(RR_lists)
+    for RR_list, mask in zip(RR_lists, masks):
+        np.testing.assert_array_equal(mask, hrvy.quotient_filter(RR_list) if len(RR_list) > 0 else [])
+    assert hrvy.quotient_filter_batch([]) == []
+    assert [len(mask) for mask in hrvy.quotient_filter_batch([[], []])] == [0, 0]
+
+
+
+## Filtering a (nodes x samples) stack into out streams it in blocks & gives exactly filtfilt's values
+def test_filter_into_out_matches_filtfilt():
+    from scipy.signal import filtfilt
+
+    data = 0.5 + np.cumsum(np.random.default_rng(2).normal(0, 0.02, (3, 50000)), axis=-1)
+    for filtertype, cutoff in [('notch', 0.05), ('highpass', 0.7), ('lowpass', 15)]:
+        (b, a) = hrvy.filter_coefficients(cutoff, 500.0, filtertype=filtertype)
+        out = data.copy()
+        hrvy.filter_signal(out, cutoff, 500.0, filtertype=filtertype, out=out)
+        np.testing.assert_array_equal(out, filtfilt(b, a, data, axis=-1))
+        np.testing.assert_array_equal(hrvy.filtfilt_blocks(b, a, data[0], block=777), filtfilt(b, a, data[0]))
@@ -0,0 +1,133 @@
+import contextlib
+import datetime as dt
+import io
+import os
+
+import numpy as np
+import pytest
+
+import hrvy_v1 as hrvy
+import legacy
+from conftest import write_dataset
+
+EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+
+
+
+## Signals the peak reductions have to get through, rounded levels, tall spikes & steep steps,
+## flat stretches, repeated values & inverted waves, with runs of one value dropped in
+def rough_signal(rng, num_vals):
+    kind = rng.integers(6)
+    if kind == 0:
+        values = np.round(np.cumsum(rng.normal(0, 0.1, num_vals)) / 0.01) * 0.01
+    elif kind == 1:
+        values = np.round(rng.normal(0.5, 0.6, num_vals) * 16) / 16
+    elif kind == 2:
+        values = np.cumsum(rng.choice([0, 0, 0, 0.01, -0.01, 0.3, -0.3, 0.6, -0.6, 2.5, -2.5, 4, -4], num_vals))
+    elif kind == 3:
+        values = 0.5 + np.cumsum(rng.normal(0, 0.004, num_vals)) + (rng.random(num_vals) < 0.002) * rng.normal(0, 4, num_vals)
+    elif kind == 4:
+        values = -np.abs(np.sin(np.arange(num_vals) / 30.)) * rng.uniform(0.5, 3) + (rng.random(num_vals) < 0.001) * 4
+    else:
+        values = np.where(rng.random(num_vals) < 0.3, 0.5, np.round(rng.normal(0.5, 1.5, num_vals), 2))
+    for start in rng.integers(0, num_vals, num_vals // 200 + 1):
+        values[start:start + rng.integers(2, 40)] = values[start]
+
+    return values
+
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_flat_peak_reduct(seed):
+    rng = np.random.default_rng(seed)
+    for trial in range(100):
+        values = rough_signal(rng, int(rng.integers(1, 4000)))
+        expected = legacy.flat_peak_reduct(values.tolist())
+        np.testing.assert_array_equal(hrvy.flat_peak_reduct(values.copy()), expected)
+        assert hrvy.flat_peak_reduct(values.tolist()) == expected
+
+
+
+## full_scan votes on every clean selection, as the loop did, the sampled vote has to settle the same way
+## on a clearly inverted record
+@pytest.mark.parametrize('seed', range(4))
+def test_tall_peak_reduct(seed):
+    rng = np.random.default_rng(seed)
+    for trial in range(60):
+        values = rough_signal(rng, int(rng.integers(1, 6000)))
+        with contextlib.redirect_stdout(io.StringIO()) as old:
+            expected = legacy.tall_peak_reduct(values.tolist())
+        with contextlib.redirect_stdout(io.StringIO()) as new:
+            reduced = hrvy.tall_peak_reduct(values.copy(), full_scan=True)
+        np.testing.assert_array_equal(reduced, expected)
+        assert new.getvalue() == old.getvalue()
+
+
+def test_tall_peak_reduct_sampled_vote():
+    values = 0.2 - np.abs(np.sin(np.arange(40000) / 30.)) ** 20
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = legacy.tall_peak_reduct(values.tolist())
+        reduced = hrvy.tall_peak_reduct(values.copy())
+    np.testing.assert_array_equal(reduced, expected)
+    assert not np.array_equal(reduced, values)
+
+
+
+## Random exports, gaps forward & back (some over 3 minutes), sparse timestamps, dropped 2ms steps on the
+## non-2ms nodes & trailing columns left off the first row & some others (csv not pre-aligned)
+def rough_dataset(path, rng):
+    num_rows = int(rng.integers(50, 4000))
+    gaps = {int(row): int(rng.choice([1, 2, 7, 40, -1, -3])) for row in rng.integers(1, num_rows, 4)}
+    if rng.random() < 0.25:
+        gaps[int(rng.integers(1, num_rows))] = 100000
+    dropouts = {int(row): int(rng.integers(1, 4)) for row in rng.integers(1, num_rows, 3)}
+    stamp_every = int(rng.choice([1, 7, 50]))
+    (hdr, csv) = write_dataset(path, num_rows, int(rng.integers(1 << 30)), gaps=gaps,
+                               stamp_every=stamp_every, dropouts=dropouts)
+    if rng.random() < 0.5:
+        cut = int(rng.integers(1, 4))
+        short = set(rng.integers(1, num_rows, num_rows // 10).tolist()) | {0}
+        csv = [', '.join(line.rstrip('\n').split(', ')[:-cut]) + '\n' if row in short else line
+               for (row, line) in enumerate(csv)]
+
+    return (hdr, csv)
+
+
+## Parses a data set with the loop version, times as int64 epoch ns
+def legacy_parse(hdr, csv):
+    (hdr_dat, nodes_not_2ms) = legacy.hdr_data(hdr)
+    (align_cont, file_dat) = legacy.align_plus_dat(hdr_dat, csv)
+    file_dat = legacy.time_out(csv, file_dat, nodes_not_2ms, align_cont)
+    file_dat['Time'] = [(time - EPOCH) // dt.timedelta(microseconds=1) * 1000 for time in file_dat['Time']]
+
+    return file_dat
+
+
+def new_recording(hdr, csv):
+    (hdr_dat, nodes_not_2ms) = hrvy.hdr_data(hdr)
+    (align_cont, file_dat) = hrvy.align_plus_dat(hdr_dat, csv)
+
+    return (file_dat, nodes_not_2ms, align_cont)
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_time_out(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    for trial in range(8):
+        (hdr, csv) = rough_dataset(os.path.join(tmp_path, 'rough'), rng)
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = legacy_parse(hdr, csv)
+            filled = hrvy.time_out_np(csv, *new_recording(hdr, csv))
+
+            ## Same again streamed in blocks split at random rows
+            cuts = sorted(rng.integers(0, len(csv), 3).tolist())
+            blocks = [csv[start:end] for (start, end) in zip([0] + cuts, cuts + [len(csv)])]
+            streamed = list(hrvy.time_out_stream(blocks, *new_recording(hdr, csv)))
+
+        assert list(filled) == list(expected)
+        for key in expected:
+            np.testing.assert_array_equal(filled[key], expected[key])
+            np.testing.assert_array_equal(np.concatenate([part[key] for part in streamed]), expected[key])
+
+        ## The gap table accounts for every sample the loop filled in
+        assert np.sum(filled.gaps['samples']) == len(expected['Time']) - len(csv)
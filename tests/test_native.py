@@ -0,0 +1,73 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+import hrvy_v1 as hrvy
+from conftest import HDR, write_dataset
+
+
+
+## Parses a data set in memory, native keeps non-2ms nodes as Channels
+## as_2ms reads every node as if it were 2ms, so each row holds exactly what was recorded (0.5 if blank)
+def parse(hdr, csv, native=False, as_2ms=False):
+    if as_2ms:
+        hdr = [line.replace('4ms', '2ms').replace('8ms', '2ms') for line in hdr]
+    with contextlib.redirect_stdout(io.StringIO()):
+        (hdr_dat, nodes_not_2ms) = hrvy.hdr_data(hdr)
+        (align_cont, file_dat) = hrvy.align_plus_dat(hdr_dat, csv)
+        return hrvy.time_out_np(csv, file_dat, nodes_not_2ms, align_cont, native)
+
+
+
+## Every recorded value of a slow node is kept, also after dropouts that restart it on another phase
+@pytest.mark.parametrize('seed, dropouts', [(0, {}), (1, {1500: 1}), (2, {700: 1, 2600: 3, 4100: 1}),
+                                            (3, {3000: 2, 3001: 1})])
+def test_native_keeps_recorded_values(tmp_path, seed, dropouts):
+    gaps = {2000: 7, 4000: 300}
+    gaps.update({row: 3 for row in dropouts})
+    (hdr, csv) = write_dataset(os.path.join(tmp_path, 'nat'), seed=seed, gaps=gaps, dropouts=dropouts)
+    native = parse(hdr, csv, native=True)
+    recorded = parse(hdr, csv, as_2ms=True)
+
+    for key, channel in native.nodes.items():
+        if not isinstance(channel, hrvy.Channel):
+            continue
+        rows = np.flatnonzero(recorded[key] != 0.5)
+        assert np.array_equal(native.grid(key)[rows], recorded[key][rows]), key
+        assert np.count_nonzero(channel.values != 0.5) == len(rows), key
+
+
+
+## Blocks, cache & appends give the same Channels as one in-memory parse
+def test_native_phases_through_blocks_and_cache(tmp_path):
+    path = os.path.join(tmp_path, 'nat')
+    (hdr, csv) = write_dataset(path, seed=5, gaps={1000: 3, 2000: 7, 3500: 3}, dropouts={1000: 1, 3500: 1})
+    native = parse(hdr, csv, native=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        parsed = hrvy.parse_dataset(hdr, path + '.csv', 0, None, native=True, block_rows=777)
+        with open(path + '.csv', 'w') as f:
+            f.writelines(csv[:2500])
+        hrvy.open_dataset(path, native=True)
+        with open(path + '.csv', 'a') as f:
+            f.writelines(csv[2500:])
+        cached = hrvy.open_dataset(path, native=True)
+
+    for rec in (parsed, cached):
+        for key in native.nodes:
+            assert np.array_equal(rec.grid(key), native.grid(key)), key
+
+
+
+## open_dataset keeps filling non-2ms nodes in on the 2ms grid unless native is asked for
+def test_native_is_opt_in(tmp_path):
+    path = os.path.join(tmp_path, 'nat')
+    (hdr, csv) = write_dataset(path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        rec = hrvy.open_dataset(path)
+    filled = parse(hdr, csv)
+    for key in filled:
+        assert not isinstance(rec[key], hrvy.Channel), key
+        assert np.array_equal(rec[key], filled[key]), key
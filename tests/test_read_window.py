@@ -0,0 +1,38 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+import hrvy_v1 as hrvy
+from conftest import write_dataset
+
+
+
+## Full in-memory parse of a data set written by write_dataset
+def full_parse(hdr, csv):
+    with contextlib.redirect_stdout(io.StringIO()):
+        (hdr_dat, nodes_not_2ms) = hrvy.hdr_data(hdr)
+        (align_cont, file_dat) = hrvy.align_plus_dat(hdr_dat, csv)
+        return hrvy.time_out_np(csv, file_dat, nodes_not_2ms, align_cont)
+
+
+
+## Random windows, dense & sparse indexes, block boundaries landing anywhere near the window's end
+@pytest.mark.parametrize('seed, every, block_rows, stamp_every', [(1, 1, 50000, 1), (2, 7, 333, 1),
+                                                                 (3, 1, 333, 1), (4, 3, 97, 5)])
+def test_read_window_matches_full_parse(tmp_path, seed, every, block_rows, stamp_every):
+    path = os.path.join(tmp_path, 'win')
+    (hdr, csv) = write_dataset(path, seed=seed, stamp_every=stamp_every)
+    full = full_parse(hdr, csv)
+    rng = np.random.default_rng(seed)
+
+    for n in range(40):
+        (first, last) = sorted(rng.integers(0, len(full['Time']), 2))
+        with contextlib.redirect_stdout(io.StringIO()):
+            window = hrvy.read_window(path, full['Time'][first], full['Time'][last], every=every,
+                                      block_rows=block_rows)
+        assert np.array_equal(window['Time'], full['Time'][first:last])
+        for key in full.nodes:
+            assert np.array_equal(window[key], full[key][first:last]), (n, key, first, last)
@@ -0,0 +1,31 @@
+import datetime as dt
+
+import numpy as np
+import pytest
+
+import hrvy_v1 as hrvy
+
+EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+
+
+
+## The fast path reads every day of every month (leap years too) the way strptime does
+def test_every_day_matches_strptime():
+    stamps = []
+    day = dt.date(1896, 1, 1)
+    while day < dt.date(2004, 1, 1):
+        stamps.append(day.strftime('%Y-%m-%d') + ' 23:59:59.998 -0500')
+        day += dt.timedelta(days=1)
+    (times, tz) = hrvy.decode_timestamps(stamps)
+    expected = [(dt.datetime.strptime(stamp, '%Y-%m-%d %H:%M:%S.%f %z') - EPOCH) // dt.timedelta(microseconds=1) * 1000
+                for stamp in stamps]
+    np.testing.assert_array_equal(times, expected)
+
+
+
+## Days past the end of their month are not rolled over into the next one
+@pytest.mark.parametrize('date', ['2021-02-30', '2021-02-29', '1900-02-29', '2021-04-31', '2021-06-31'])
+def test_day_outside_its_month(date):
+    stamps = ['2021-02-10 12:00:00.000 -0500', date + ' 12:00:00.002 -0500']
+    with pytest.raises(ValueError):
+        hrvy.decode_timestamps(stamps)